@@ -72,15 +72,22 @@ class CustomDatasetDataLoader():
         dataset_class = find_dataset_using_name(opt.dataset_mode)
         self.dataset = dataset_class(opt)
         print("dataset [%s] was created" % type(self.dataset).__name__)
+        # Iterable datasets shuffle themselves, DataLoader rejects shuffle for them
+        iterable = isinstance(self.dataset, torch.utils.data.IterableDataset)
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=opt.batch_size,
-            shuffle=not opt.serial_batches,
+            shuffle=not opt.serial_batches and not iterable,
             num_workers=int(opt.num_threads))
 
     def load_data(self):
         return self
 
+    def set_epoch(self, epoch):
+        """Forward the epoch to datasets whose sample order depends on it"""
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(epoch)
+
     def __len__(self):
         """Return the number of data in the dataset"""
         return min(len(self.dataset), self.opt.max_dataset_size)
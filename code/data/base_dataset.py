@@ -116,6 +116,13 @@ def get_transform(opt, params=None, grayscale=False, order=3, convert=True):
     return Compose(transform_list)
 
 
+def transform_is_deterministic(opt):
+    # Whether get_transform(opt) maps the same input to the same output
+    # NOTE: crops of images resized to at most crop_size keep the whole image
+    crop_is_identity = 'resize' in opt.preprocess and opt.load_size <= opt.crop_size
+    return ('crop' not in opt.preprocess or crop_is_identity) and opt.no_flip
+
+
 def __make_power_2(img, base, order=3):
     ow, oh = img.size
     h = int(round(oh / base) * base)
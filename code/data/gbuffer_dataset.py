@@ -7,8 +7,9 @@ import re
 import numpy as np
 import torch
 
-from data.base_dataset import BaseDataset, get_transform
+from data.base_dataset import BaseDataset, get_transform, transform_is_deterministic
 from data.image_folder import make_dataset
+from util.gbuffer_util import GbufferStore, MASK_CHANNELS, NORMAL_CHANNELS, POSITION_CHANNELS
 from util.image_util import imread, imwrite
 from util.misc_util import get_fn
 from util.transform_util import GaussianNoiseNP, ToTensor, Resize
@@ -19,14 +20,17 @@ class GbufferDataset(BaseDataset):
     def modify_commandline_options(parser, is_train):
         parser.add_argument('--config_fn', type=str, default='data.json', help='name of dataset config file')
         parser.add_argument('--gbuffer_root', type=str, default='./datasets/gbuffers/', help='Root directory for gbuffers')
+        parser.add_argument('--gbuffer_store', action='store_true', help='Read gbuffers from the packed G-buffer store instead of PNGs')
+        parser.add_argument('--no_gbuffer_cache', action='store_true', help='Do not precompute the gbuffer tensors of every mesh in shared memory')
         parser.add_argument('--gaussian_sigma', type=float, default=0.0, help='STD for Gaussian noise to applied on dataset')
         return parser
 
     def __init__(self, opt):
         BaseDataset.__init__(self, opt)
 
-        self.config = json.loads(
-                open(os.path.join(opt.dataroot, opt.config_fn)).read())
+        config_path = os.path.join(opt.dataroot, opt.config_fn)
+        self.config = json.loads(open(config_path).read()) \
+                      if os.path.exists(config_path) else dict()
         self.dataset_size = len(self.config)
         self.dataset_keys = sorted(list(self.config.keys()))
 
@@ -36,6 +40,7 @@ class GbufferDataset(BaseDataset):
         self.dir_gbuffer_position = os.path.join(opt.gbuffer_root, 'position')
         self.dir_gbuffer_normal   = os.path.join(opt.gbuffer_root, 'normal')
         self.dir_gbuffer_mask     = os.path.join(opt.gbuffer_root, 'mask')
+        self.gbuffer_store = GbufferStore.load(opt.gbuffer_root) if opt.gbuffer_store else None
 
         self.noise = GaussianNoiseNP(opt.gaussian_sigma)
 
@@ -43,20 +48,28 @@ class GbufferDataset(BaseDataset):
         self.mask_transform       = ToTensor()
         self.disc_mask_transform  = Resize(30, order=0)
 
-    def __getitem__(self, index):
-        # Load appropriate paths
-        config_key = self.dataset_keys[index % self.dataset_size]
-        mesh_label = get_fn(self.config[config_key]['geometry_path'])
+        # Gbuffers only depend on the mesh, so with deterministic transforms
+        # the final tensors are built once per mesh and shared with workers
+        self.gbuffer_cache = None
+        if not opt.no_gbuffer_cache and transform_is_deterministic(opt):
+            self.gbuffer_cache = dict()
+            for mesh_label in self.mesh_labels():
+                gbuffer, gbuffer_mask = self.load_gbuffer(mesh_label)
+                self.gbuffer_cache[mesh_label] = \
+                        (gbuffer.share_memory_(), gbuffer_mask.share_memory_())
 
-        target_img_path       = os.path.join(self.dir_target_img,       f'{config_key}.png')
-        target_mask_path      = os.path.join(self.dir_target_mask,      f'{config_key}.png')
-        gbuffer_position_path = os.path.join(self.dir_gbuffer_position, f'{mesh_label}.png')
-        gbuffer_normal_path   = os.path.join(self.dir_gbuffer_normal,   f'{mesh_label}.png')
-        gbuffer_mask_path     = os.path.join(self.dir_gbuffer_mask,     f'{mesh_label}.png')
+    def mesh_labels(self):
+        return sorted(set(get_fn(c['geometry_path']) for c in self.config.values()))
 
+    def __getitem__(self, index):
         # Load target and mask
-        target_img  = imread(target_img_path)
-        target_mask = imread(target_mask_path)
+        config_key = self.dataset_keys[index % self.dataset_size]
+        target_img, target_mask = self.load_target(config_key)
+        return self.make_sample(config_key, self.config[config_key],
+                                target_img, target_mask)
+
+    def make_sample(self, config_key, config, target_img, target_mask):
+        mesh_label = get_fn(config['geometry_path'])
 
         # Add noise to target image
         target_img  = self.noise(target_img)
@@ -70,9 +83,35 @@ class GbufferDataset(BaseDataset):
         target_mask = self.mask_transform(target_mask)
 
         # Load Gbuffer Images and alphamask
-        gbuffer_position = imread(gbuffer_position_path)
-        gbuffer_normal   = imread(gbuffer_normal_path)
-        gbuffer_mask     = imread(gbuffer_mask_path)
+        if self.gbuffer_cache is not None:
+            gbuffer, gbuffer_mask = self.gbuffer_cache[mesh_label]
+        else:
+            gbuffer, gbuffer_mask = self.load_gbuffer(mesh_label)
+
+        return {'gbuffer': gbuffer, 'gbuffer_mask': gbuffer_mask,
+                'target': target, 'target_mask': target_mask, 'disc_mask': disc_mask,
+                'config_keys': config_key}
+
+    def load_target(self, config_key):
+        target_img_path  = os.path.join(self.dir_target_img,  f'{config_key}.png')
+        target_mask_path = os.path.join(self.dir_target_mask, f'{config_key}.png')
+        return imread(target_img_path), imread(target_mask_path)
+
+    def load_gbuffer(self, mesh_label):
+        gbuffer_position_path = os.path.join(self.dir_gbuffer_position, f'{mesh_label}.png')
+        gbuffer_normal_path   = os.path.join(self.dir_gbuffer_normal,   f'{mesh_label}.png')
+        gbuffer_mask_path     = os.path.join(self.dir_gbuffer_mask,     f'{mesh_label}.png')
+
+        # Load Gbuffer Images and alphamask
+        if self.gbuffer_store is not None:
+            packed           = self.gbuffer_store[mesh_label]
+            gbuffer_position = packed[:,:,POSITION_CHANNELS].astype(np.float32)
+            gbuffer_normal   = packed[:,:,NORMAL_CHANNELS].astype(np.float32)
+            gbuffer_mask     = packed[:,:,MASK_CHANNELS].astype(np.float32)
+        else:
+            gbuffer_position = imread(gbuffer_position_path)
+            gbuffer_normal   = imread(gbuffer_normal_path)
+            gbuffer_mask     = imread(gbuffer_mask_path)
 
         gbuffer     = np.concatenate([gbuffer_position, gbuffer_normal], axis=-1)
         gbuffer     = gbuffer * gbuffer_mask[:,:,:1]
@@ -80,10 +119,7 @@ class GbufferDataset(BaseDataset):
 
         gbuffer_mask = np.repeat(gbuffer_mask[:,:,:1], 4, axis=-1)
         gbuffer_mask = self.mask_transform(gbuffer_mask)
-
-        return {'gbuffer': gbuffer, 'gbuffer_mask': gbuffer_mask,
-                'target': target, 'target_mask': target_mask, 'disc_mask': disc_mask,
-                'config_keys': config_key}
+        return gbuffer, gbuffer_mask
 
     def __len__(self):
         return self.dataset_size
@@ -0,0 +1,79 @@
+import json
+import random
+
+import torch
+import torch.utils.data
+
+from data.gbuffer_dataset import GbufferDataset
+from util.misc_util import get_child_paths, get_fn
+from util.render_util import Render, RenderConfig, load_texture
+from util.sample_util import SceneSamplerFactory
+
+
+class GbufferRenderDataset(GbufferDataset, torch.utils.data.IterableDataset):
+    """GbufferDataset rendering its targets on the fly
+
+    Every DataLoader worker samples scenes from the render_dataset.py scene
+    distribution and path traces them with its own CPU Render. Samples carry
+    their scene as a JSON string under 'configs', so no data.json is needed.
+    Worker streams are seeded from --render_seed, the epoch and the worker id
+    through a private generator, the global random state is left untouched.
+    Epochs are cut to --render_epoch_size samples of the otherwise unbounded
+    stream, so set_epoch and progress reporting keep working.
+    """
+    @staticmethod
+    def modify_commandline_options(parser, is_train):
+        parser = GbufferDataset.modify_commandline_options(parser, is_train)
+        parser.add_argument('--geometry_path', type=str, default='./datasets/meshes/clean_serialized', help='Directory of serialized meshes scenes are sampled from')
+        parser.add_argument('--envmaps_path', type=str, default='./datasets/envmaps/one', help='Directory of envmaps scenes are sampled from')
+        parser.add_argument('--diffuse_refl_path', type=str, default='./datasets/distributions/diffuse.txt', help='Diffuse reflectance distribution scenes are sampled from')
+        parser.add_argument('--textures_path', type=str, default='./datasets/textures/curve', help='Directory of per mesh target textures')
+        parser.add_argument('--texture_size', type=int, default=256, help='Resolution target textures are resized to')
+        parser.add_argument('--render_epoch_size', type=int, default=1000, help='Number of targets rendered per epoch')
+        parser.add_argument('--render_seed', type=int, default=0, help='Base seed of the per worker scene streams')
+        return parser
+
+    def __init__(self, opt):
+        GbufferDataset.__init__(self, opt)
+        self.dataset_size = opt.render_epoch_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def mesh_labels(self):
+        return sorted(get_fn(p) for p in get_child_paths(self.opt.geometry_path, 'pth'))
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) \
+                                 if worker_info is not None else (0, 1)
+
+        rng = random.Random(self.opt.render_seed + self.epoch * 65536 + worker_id)
+        sampler = SceneSamplerFactory(self.opt.geometry_path, self.opt.envmaps_path,
+                                      self.opt.diffuse_refl_path, rng)
+
+        config = RenderConfig()
+        renderer = Render(config, torch.device('cpu'))
+        textures = dict()
+
+        num_samples = len(range(worker_id, self.dataset_size, num_workers))
+        for i in range(num_samples):
+            scene = sampler.generate()
+            config.set_scene(scene)
+
+            geometry_path = scene['geometry_path']
+            if geometry_path not in textures:
+                textures[geometry_path] = load_texture(
+                        self.opt.textures_path, geometry_path,
+                        self.opt.texture_size, renderer.device)
+            with torch.no_grad():
+                out = renderer(textures[geometry_path]).numpy()
+
+            config_key = f'{self.epoch}_{worker_id}_{i}'
+            sample = self.make_sample(config_key, scene, out[..., :3], out[..., 3:4])
+            sample['configs'] = json.dumps(scene)
+            yield sample
+
+    def __len__(self):
+        return self.dataset_size
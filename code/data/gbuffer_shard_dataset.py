@@ -0,0 +1,22 @@
+from data.gbuffer_dataset import GbufferDataset
+from util.shard_util import ShardReader
+
+
+class GbufferShardDataset(GbufferDataset):
+    """GbufferDataset reading targets from shards written by preprocess_pack_shards.py
+
+    dataroot is the shard directory, holding index.json, the shard files and data.json.
+    """
+    @staticmethod
+    def modify_commandline_options(parser, is_train):
+        parser = GbufferDataset.modify_commandline_options(parser, is_train)
+        parser.add_argument('--shard_prefetch', type=int, default=8, help='Number of following records prefetched after every read, 0 disables prefetching')
+        return parser
+
+    def __init__(self, opt):
+        GbufferDataset.__init__(self, opt)
+        self.shards = ShardReader(opt.dataroot, opt.shard_prefetch)
+
+    def load_target(self, config_key):
+        target_img, target_mask, _ = self.shards.read(config_key)
+        return target_img, target_mask
@@ -0,0 +1,119 @@
+import os
+import queue
+import random
+import threading
+
+import torch
+import torch.utils.data
+
+from data.gbuffer_shard_dataset import GbufferShardDataset
+
+
+def get_rank():
+    # (rank, world size) of this process in distributed training
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+class GbufferStreamDataset(GbufferShardDataset, torch.utils.data.IterableDataset):
+    """Streams the shards of a GbufferShardDataset sequentially
+
+    Shards are split across ranks, then across the DataLoader workers of a
+    rank. Each worker reads its shards front to back with a read-ahead thread
+    and shuffles them through a bounded in-memory buffer. len() is the number
+    of records streamed by this rank.
+    Call set_epoch before every epoch to change the shard order and shuffle.
+    """
+    @staticmethod
+    def modify_commandline_options(parser, is_train):
+        parser = GbufferShardDataset.modify_commandline_options(parser, is_train)
+        parser.add_argument('--shuffle_buffer', type=int, default=1024, help='Number of samples shuffled in memory, 1 streams in shard order')
+        parser.add_argument('--read_ahead', type=int, default=64, help='Number of records decoded ahead of the shuffle buffer')
+        parser.add_argument('--stream_seed', type=int, default=0, help='Seed of the shard order and shuffle buffer')
+        return parser
+
+    def __init__(self, opt):
+        GbufferShardDataset.__init__(self, opt)
+        self.epoch = 0
+        self.shuffle = not opt.serial_batches
+        # Number of records with a scene config in every shard
+        self.shard_sizes = [
+            sum(1 for key in keys if key in self.config)
+            for keys in self.shards.shard_keys]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def rank_shards(self):
+        # Same shard order on every rank, each takes a strided slice
+        shards = list(range(len(self.shards.shards)))
+        if self.shuffle:
+            random.Random(self.opt.stream_seed + self.epoch).shuffle(shards)
+        rank, world_size = get_rank()
+        return shards[rank::world_size], rank
+
+    def assigned_shards(self):
+        # DataLoader workers split the shards of their rank
+        shards, rank = self.rank_shards()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) \
+                                 if worker_info is not None else (0, 1)
+        return shards[worker_id::num_workers], rank * num_workers + worker_id
+
+    def read_records(self, shards, records, stop):
+        # Decodes the records of the given shards in file order
+        def put(item):
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for shard in shards:
+                for key in self.shards.shard_keys[shard]:
+                    if key not in self.config:
+                        continue
+                    target_img, target_mask, config = self.shards.read(key)
+                    if not put((key, config, target_img, target_mask)):
+                        return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def __iter__(self):
+        shards, consumer = self.assigned_shards()
+        rng = random.Random(self.opt.stream_seed + self.epoch * 65536 + consumer)
+        buffer_size = self.opt.shuffle_buffer if self.shuffle else 1
+
+        records = queue.Queue(maxsize=max(1, self.opt.read_ahead))
+        stop = threading.Event()
+        reader = threading.Thread(target=self.read_records,
+                                  args=(shards, records, stop), daemon=True)
+        reader.start()
+        try:
+            buffer = list()
+            for record in iter(records.get, None):
+                if isinstance(record, Exception):
+                    raise record
+                buffer.append(record)
+                if len(buffer) >= buffer_size:
+                    # Swap a random sample out of the full buffer
+                    i = rng.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield self.make_sample(*buffer.pop())
+            rng.shuffle(buffer)
+            for record in buffer:
+                yield self.make_sample(*record)
+        finally:
+            stop.set()
+            reader.join()
+
+    def __len__(self):
+        # Records this rank streams in the current epoch
+        shards, _ = self.rank_shards()
+        return sum(self.shard_sizes[shard] for shard in shards)
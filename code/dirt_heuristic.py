@@ -4,7 +4,7 @@ import numpy as np
 import skimage.filters
 from skimage.transform import resize
 
-from util.image_util import imread, imwrite
+from util.image_util import AsyncImageWriter, imread
 from util.misc_util import *
 
 def height_dirt(position, normal, mask):
@@ -62,16 +62,17 @@ def main():
     HEIGHT_DIRT_ROOT = './datasets/textures/height'
     CURVE_DIRT_ROOT = './datasets/textures/curve'
 
-    for name in CAR_ROSTER:
-        print(f'Generating dirt for {name}')
-        pos = imread(os.path.join(POS_GBUF_ROOT, f'{name}.png'))
-        nrm = imread(os.path.join(NOR_GBUF_ROOT, f'{name}.png'))
-        msk = imread(os.path.join(MSK_GBUF_ROOT, f'{name}.png'))
-
-        h_dirt = height_dirt(pos, nrm, msk)
-        imwrite(h_dirt, os.path.join(HEIGHT_DIRT_ROOT, f'{name}.png'))
-        c_dirt = curve_dirt(pos, nrm, msk)
-        imwrite(c_dirt, os.path.join(CURVE_DIRT_ROOT, f'{name}.png'))
+    with AsyncImageWriter() as writer:
+        for name in CAR_ROSTER:
+            print(f'Generating dirt for {name}')
+            pos = imread(os.path.join(POS_GBUF_ROOT, f'{name}.png'))
+            nrm = imread(os.path.join(NOR_GBUF_ROOT, f'{name}.png'))
+            msk = imread(os.path.join(MSK_GBUF_ROOT, f'{name}.png'))
+
+            h_dirt = height_dirt(pos, nrm, msk)
+            writer.write(h_dirt, os.path.join(HEIGHT_DIRT_ROOT, f'{name}.png'))
+            c_dirt = curve_dirt(pos, nrm, msk)
+            writer.write(c_dirt, os.path.join(CURVE_DIRT_ROOT, f'{name}.png'))
 
 if __name__ == '__main__':
     main()
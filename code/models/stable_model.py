@@ -33,6 +33,12 @@ class StableModel(BaseModel):
         # Network Config
         parser.add_argument('--texture_nc', type=int, default=4, help='Number of channels in the texture output')
 
+        # Render Config
+        parser.add_argument('--mesh_cache_mb', type=int, default=2048, help='Memory budget (MB) for deserialized meshes cached by the renderer')
+        parser.add_argument('--envmap_cache_size', type=int, default=16, help='Number of prepared environment maps cached by the renderer')
+        parser.add_argument('--render_mode', type=str, default='path', help='chooses how synthetic images are rendered. [path | deferred]. deferred reconstructs renders from the transfer bakes in [dataroot]/transfer written by preprocess_bake_transfer.py')
+        parser.add_argument('--transfer_cache_mb', type=int, default=2048, help='Memory budget (MB) for transfer bakes cached by the deferred renderer')
+
         return parser
 
     def __init__(self, opt):
@@ -60,33 +66,45 @@ class StableModel(BaseModel):
         self.netG = networks.define_G(opt.input_nc, opt.texture_nc, opt.ngf, opt.netG, opt.norm,
                                       not opt.no_dropout, opt.init_type, opt.init_gain, self.gpu_ids)
         # 2. Pre-processing:
-        #    - Strip batch dimension
         #    - Normalize to [0,1] domain
-        #    - Switch dimension order
         #    - Mask out unlearneable texture values **applied at runtime**
         self.pre_process = nn.Sequential(
-                StripBatchDimLayer(),
                 NormalizeLayer(-1.0, 2.0),
-                CHW2HWCLayer(),
         )
 
         # 3. Render Image
-        self.scene_dict = json.loads(open(os.path.join(opt.dataroot, 'data.json')).read())
+        # NOTE: datasets rendering on the fly pass their scenes as 'configs'
+        #       and do not need a data.json
+        scene_dict_path = os.path.join(opt.dataroot, 'data.json')
+        self.scene_dict = json.loads(open(scene_dict_path).read()) \
+                          if os.path.exists(scene_dict_path) else dict()
         self.render_config = RenderConfig()
-        self.override = ConfigSampler({
-            #'envmap_path'   : PathSamplerFactory(
-            #    './datasets/envmaps/rasters', ext='exr'),
-            'envmap_rotation'    : UniformSamplerFactory(0.0, 1.0),
-        })
-
-        self.render        = RenderLayer(self.render_config, self.device, True)
+        if opt.render_mode == 'path':
+            self.override = ConfigSampler({
+                #'envmap_path'   : PathSamplerFactory(
+                #    './datasets/envmaps/rasters', ext='exr'),
+                'envmap_rotation'    : UniformSamplerFactory(0.0, 1.0),
+            })
+
+            self.render    = RenderLayer(self.render_config, self.device, True,
+                                         mesh_cache_bytes=opt.mesh_cache_mb * 1024 ** 2,
+                                         envmap_cache_entries=opt.envmap_cache_size)
+        elif opt.render_mode == 'deferred':
+            # Scene parameters are baked, point each scene to its transfer file
+            self.transfer_dir = os.path.join(opt.dataroot, 'transfer')
+            self.override = ConfigSampler({})
+
+            self.render    = DeferredRenderLayer(self.render_config, self.device, True,
+                                         transfer_cache_bytes=opt.transfer_cache_mb * 1024 ** 2)
+        else:
+            raise NotImplementedError('render mode [%s] is not implemented' % opt.render_mode)
 
         # 4. Post-processing:
+        #    - Switch dimension order
         #    - Add Signal Noise
         #    - Composit Alpha layer to mask out environment map
         #    - Undo switch dimension order
         #    - Undo normalization
-        #    - Add back batch dimension
         noise_kwargs = {
             "sigma": opt.gaussian_sigma,
             "device": self.device,
@@ -97,11 +115,11 @@ class StableModel(BaseModel):
             "device": self.device,
         }
         self.post_process = nn.Sequential(
+            NCHW2NHWCLayer(),
             GaussianNoiseLayer(**noise_kwargs),
             CompositLayer(**composit_kwargs),
-            HWC2CHWLayer(),
+            NHWC2NCHWLayer(),
             NormalizeLayer(0.5, 0.5),
-            AddBatchDimLayer(),
         )
 
         background = imread(opt.viz_composit_bkgd_path)
@@ -133,10 +151,12 @@ class StableModel(BaseModel):
     def set_input(self, input):
         self.gbuffer = input['gbuffer'].to(self.device)
         self.target = input['target'].to(self.device)
-        self.gbuffer_mask = input['gbuffer_mask'].to(self.device)[0,...]
-        self.target_mask = input['target_mask'].to(self.device)[0,...]
-        self.disc_mask = input['disc_mask'].to(self.device)[0,...]
-        self.config_key = input['config_keys'][0]
+        self.gbuffer_mask = input['gbuffer_mask'].to(self.device).permute(0, 3, 1, 2)
+        self.target_mask = input['target_mask'].to(self.device).permute(0, 3, 1, 2)
+        self.disc_mask = input['disc_mask'].to(self.device)
+        self.config_keys = input['config_keys']
+        self.scene_configs = [json.loads(c) for c in input['configs']] \
+                             if 'configs' in input else None
 
         # Process visuals
         self.gbuffer_position = self.gbuffer[:,0:3,...]
@@ -148,20 +168,25 @@ class StableModel(BaseModel):
         self.synth_tex = self.pre_process(self.synth_tex)
         self.synth_tex = self.synth_tex * self.gbuffer_mask
         # Set camera parameters and pass to renderer
-        scene = self.scene_dict[self.config_key]
-        scene_override = self.override.generate()
-        for k, v in scene_override.items():
-            scene[k] = v
-        self.render_config.set_scene(scene)
-        self.synth = self.render(self.synth_tex)
+        scenes = list()
+        for i, config_key in enumerate(self.config_keys):
+            if self.scene_configs is not None:
+                scene = dict(self.scene_configs[i])
+            else:
+                scene = dict(self.scene_dict[config_key])
+            scene.update(self.override.generate())
+            if self.opt.render_mode == 'deferred':
+                scene['transfer_path'] = os.path.join(self.transfer_dir, f'{config_key}.npz')
+            scenes.append(scene)
+        self.synth = self.render(self.synth_tex, scenes)
         # Post-process
-        self.synth = torch.cat([self.synth, self.target_mask], dim=-1)
+        self.synth = torch.cat([self.synth, self.target_mask], dim=1)
         self.synth = self.post_process(self.synth)
 
         # Process visuals
         with torch.no_grad():
-            self.synth_tex_show = self.synth_tex.clone()
-            self.synth_tex_show[:,:,-1] = self.synth_tex_show[:,:,-1] + (1 - self.synth_tex_show[:,:,-1]) * (1 - self.gbuffer_mask[:,:,0])
+            self.synth_tex_show = self.synth_tex[0].permute(1, 2, 0).clone()
+            self.synth_tex_show[:,:,-1] = self.synth_tex_show[:,:,-1] + (1 - self.synth_tex_show[:,:,-1]) * (1 - self.gbuffer_mask[0,0,:,:])
             self.synth_tex_show = self.composit_layer(self.synth_tex_show)
 
     def backward_D_basic(self, netD, real, fake):
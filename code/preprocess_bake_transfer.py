@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from util.misc_util import *
+from util.render_util import Render, RenderConfig
+
+
+# Resolution of the constant textures used while baking
+BAKE_TEX_SIZE = 4
+
+def bake_scene(renderer, config, scene):
+    # Renders the scene with constant learnable materials isolating each term of
+    #   base + irradiance * diffuse(uv) + specular * (1 - alpha(uv))
+    # NOTE: all renders share opt_render_seed, so their noise mostly cancels
+    #       out in the differences below
+    def render(rgba, channels, **overrides):
+        baked_scene = dict(scene)
+        baked_scene['opt_channels_str'] = channels
+        baked_scene.update(overrides)
+        config.set_scene(baked_scene)
+        texture = torch.tensor(rgba, dtype=torch.float32, device=renderer.device)\
+                       .expand(BAKE_TEX_SIZE, BAKE_TEX_SIZE, 4).contiguous()
+        return renderer(texture).cpu().numpy()
+
+    geometry = render([0.0, 0.0, 0.0, 1.0], ['uv', 'alpha'])
+    base = render([0.0, 0.0, 0.0, 1.0], ['radiance'])
+    white = render([1.0, 1.0, 1.0, 1.0], ['radiance'])
+    glossy = render([0.0, 0.0, 0.0, 0.0], ['radiance'],
+                    tex_diffuse_color=[0.0, 0.0, 0.0])
+
+    return {
+        'uv': geometry[..., :2],
+        'alpha': geometry[..., 2:3],
+        'base': base,
+        'irradiance': white - base,
+        'specular': glossy - base,
+    }
+
+def main():
+    # Load arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', type=str, default='./datasets/renders/debug',
+            help='Render directory whose data.json scenes are baked')
+    parser.add_argument('--config_fn', type=str, default='data.json')
+    parser.add_argument('--gpu_id', type=int, default=0)
+    parser.add_argument('--overwrite', action='store_true',
+            help='Re-bake scenes that already have a transfer file')
+    opt = parser.parse_args()
+
+    with open(os.path.join(opt.dataroot, opt.config_fn), 'r') as f:
+        scenes = json.load(f)
+
+    out_path = os.path.join(opt.dataroot, 'transfer')
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    # Init renderer
+    device = torch.device(f'cuda:{opt.gpu_id}' if opt.gpu_id != -1 else 'cpu')
+    config = RenderConfig()
+    renderer = Render(config, device)
+
+    for i, key in enumerate(sorted(scenes.keys())):
+        transfer_path = os.path.join(out_path, f'{key}.npz')
+        if os.path.exists(transfer_path) and not opt.overwrite:
+            continue
+
+        iter_start_time = time.time()
+        transfer = bake_scene(renderer, config, scenes[key])
+        bake_time = time.time() - iter_start_time
+        print(f'Baked Transfer: #\t{i} -- {key} in {bake_time}')
+
+        # Write through a temporary file so interrupted runs can be resumed
+        tmp_path = os.path.join(out_path, f'{key}.tmp.npz')
+        np.savez(tmp_path, **transfer)
+        os.replace(tmp_path, transfer_path)
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,15 @@ import skimage
 import skimage.morphology
 from PIL import Image
 
-from util.image_util import imread, imwrite
+from util.image_util import imread_many, imwrite
 
 ROOT_DIR = './datasets/cosy/'
 RAW_IMG_DIR = os.path.join(ROOT_DIR, 'raw/img')
 LABEL_DIR = os.path.join(ROOT_DIR, 'raw/label')
 MASK_DIR = os.path.join(ROOT_DIR, 'mask')
 IMG_DIR = os.path.join(ROOT_DIR, 'img')
+# Number of raw EXRs decoded together
+READ_CHUNK = 16
 
 
 if not os.path.exists(MASK_DIR):
@@ -71,41 +73,41 @@ def center_and_scale(img, mask):
 
     return (img, mask)
 
-fn_list = os.listdir(RAW_IMG_DIR)
-for fn in fn_list:
-    # Fetch file metadata
-    fn = fn.split('.')[0]
-    #if fn != 'frame_0005_0_5_5049041':
-    #    continue
-    print('Processing: {}'.format(fn), end='\t')
-    img_fpath = os.path.join(RAW_IMG_DIR, '{}.exr'.format(fn))
-    label_fpath = os.path.join(LABEL_DIR, 'label_{}.png'.format(fn))
-
-    # Open images. Open label using PIL because image is encoded in uint8
-    img = imread(img_fpath)
-    label = np.array(Image.open(label_fpath))
-
-    # Isolate masks
-    label[label != 250] = 0.
-    label[label == 250] = 1.
-
-    # Clean up the mask
-    label = label.astype(bool)
-    threshold = 70000
-    skimage.morphology.remove_small_objects(
-            label, min_size = threshold,in_place=True)
-    skimage.morphology.remove_small_holes(label, area_threshold = threshold, in_place=True)
-    label = label.astype('uint8')
-
-    # Normalize the mask
-    out = center_and_scale(img, label)
-
-    # Reject if there was an issue with the image
-    if out == None:
-        print('Rejecting: {}'.format(fn))
-        continue
-
-    # Write to disk
-    print('Writing: {}'.format(fn))
-    imwrite(out[0], os.path.join(IMG_DIR, '{}.png'.format(fn)))
-    imwrite(out[1], os.path.join(MASK_DIR, 'label_{}.png'.format(fn)))
+fn_list = [fn.split('.')[0] for fn in os.listdir(RAW_IMG_DIR)]
+for start in range(0, len(fn_list), READ_CHUNK):
+    chunk = fn_list[start:start + READ_CHUNK]
+    imgs = imread_many([os.path.join(RAW_IMG_DIR, '{}.exr'.format(fn)) for fn in chunk])
+    for fn, img in zip(chunk, imgs):
+        # Fetch file metadata
+        #if fn != 'frame_0005_0_5_5049041':
+        #    continue
+        print('Processing: {}'.format(fn), end='\t')
+        label_fpath = os.path.join(LABEL_DIR, 'label_{}.png'.format(fn))
+
+        # Open label using PIL because image is encoded in uint8
+        label = np.array(Image.open(label_fpath))
+
+        # Isolate masks
+        label[label != 250] = 0.
+        label[label == 250] = 1.
+
+        # Clean up the mask
+        label = label.astype(bool)
+        threshold = 70000
+        skimage.morphology.remove_small_objects(
+                label, min_size = threshold,in_place=True)
+        skimage.morphology.remove_small_holes(label, area_threshold = threshold, in_place=True)
+        label = label.astype('uint8')
+
+        # Normalize the mask
+        out = center_and_scale(img, label)
+
+        # Reject if there was an issue with the image
+        if out == None:
+            print('Rejecting: {}'.format(fn))
+            continue
+
+        # Write to disk
+        print('Writing: {}'.format(fn))
+        imwrite(out[0], os.path.join(IMG_DIR, '{}.png'.format(fn)))
+        imwrite(out[1], os.path.join(MASK_DIR, 'label_{}.png'.format(fn)))
@@ -4,11 +4,15 @@ import math
 import os
 
 import numpy as np
-import skimage
-import skimage.morphology
+import torch
 
+import pyredner
+
+from util.geometry_util import camera_parameters_torch
 from util.image_util import imread
 from util.misc_util import *
+from util.pose_util import BitPoseBank, PoseBank, PoseIndex, PyramidSearch, load_masks
+from util.render_util import LearnMesh, render_alpha
 
 
 # Argparser
@@ -16,47 +20,129 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--dataroot', type=str, default='./datasets/cosy/', help='Path to dataset for pose estimation')
 parser.add_argument('--resolution', type=int, default=256, help='resolution')
 parser.add_argument('--pose_bank_path', type=str, default='./datasets/poses/octavia_clean', help='Path for pose bank to use')
+parser.add_argument('--rebuild_bank', action='store_true', help='Repack the pose bank even if an up to date packed bank exists')
+parser.add_argument('--bit_packed', action='store_true', help='Store and search the pose bank at 1 bit per pixel')
+parser.add_argument('--metric', type=str, default='l2', help='Mask distance used for matching [l2 | iou]')
+parser.add_argument('--top_k', type=int, default=1, help='Number of candidate poses to keep per image, extra candidates are written to poses.json')
+parser.add_argument('--index', action='store_true', help='Search an approximate PCA + KD-tree index and re-rank its candidates exactly')
+parser.add_argument('--index_dims', type=int, default=16, help='Number of principal components kept by the pose index')
+parser.add_argument('--index_samples', type=int, default=4096, help='Number of bank masks used to fit the principal components')
+parser.add_argument('--index_candidates', type=int, default=64, help='Number of index candidates re-ranked exactly per query')
+parser.add_argument('--pyramid', type=str, default='', help='Comma separated coarse-to-fine search resolutions, e.g. 32,64,128. Empty searches at full resolution only')
+parser.add_argument('--survivors', type=str, default='1024,128,16', help='Comma separated number of candidates kept after each pyramid level')
+parser.add_argument('--refine', action='store_true', help='Refine retrieved poses by optimizing the camera rotation against each target mask')
+parser.add_argument('--geometry_path', type=str, default='./datasets/meshes/clean_serialized/octavia_clean.pth', help='Serialized mesh of the pose bank model, used for refinement')
+parser.add_argument('--refine_resolution', type=int, default=128, help='Resolution of the alpha renders used for refinement')
+parser.add_argument('--refine_iters', type=int, default=50, help='Number of refinement iterations')
+parser.add_argument('--refine_lr', type=float, default=0.01, help='Learning rate of the refinement optimizer')
+parser.add_argument('--refine_batch', type=int, default=16, help='Number of images sharing one optimizer. Images are still rendered one at a time, this only groups their optimizer steps')
 opt = parser.parse_args()
 
-def crop_and_rescale(img):
-    img = img.astype('uint8')
-    props = skimage.measure.regionprops(img)
-    bbox = props[0].bbox
-    img = img[bbox[0]:bbox[3],bbox[1]:bbox[4],:]
-    img = skimage.transform.resize(img,
-        (opt.resolution, opt.resolution), order = 0)
-    return img
-
-# Load pose bank config
-with open(os.path.join(opt.pose_bank_path, 'data.json'), 'r') as f:
-    data = json.load(f)
-
-# Load images to estimate poses for
-fpath_list = get_child_paths(os.path.join(opt.dataroot, 'mask'))
+# Pose bank camera setup, see preprocess_generate_pose_bank.py
+TRANSLATION = [0.0, -0.75, 0.0]
+DISTANCE = 7.0
+FOV = 45.0
 
-# Initialize objects before iteration
-best_pose_dict = dict()
+def crop_to_bbox(mask, resolution):
+    # Crops an (H, W, 1) mask to the bounding box of its foreground and
+    # resamples it to a square, the framing crop_and_rescale gives the bank
+    # NOTE: the box is not differentiated, gradients flow through the pixels
+    pixels = torch.nonzero(mask[:,:,0].detach() > 0.5)
+    if len(pixels) > 0:
+        (top, left), (bottom, right) = pixels.min(0)[0], pixels.max(0)[0]
+        mask = mask[top:bottom + 1, left:right + 1]
+    mask = torch.nn.functional.interpolate(
+            mask.permute(2, 0, 1).unsqueeze(0), size=(resolution, resolution),
+            mode='bilinear', align_corners=False)
+    return mask[0].permute(1, 2, 0)
 
-for fpath in fpath_list:
-    image = crop_and_rescale(imread(fpath))
+def refine_poses(mesh, targets, rotations):
+    # Optimizes the camera rotation of a group of images against their bbox
+    # cropped target masks with single sample alpha renders. Images are
+    # rendered one after the other, their gradients accumulate into a single
+    # optimizer step per iteration.
+    # NOTE: the bbox crop removes the effect of camera translation on the
+    #       loss, so translation stays fixed at the pose bank TRANSLATION
+    rotation = torch.tensor(rotations, dtype=torch.float32, requires_grad=True)
+    translation = torch.tensor(TRANSLATION, dtype=torch.float32)
+    optimizer = torch.optim.Adam([rotation], lr=opt.refine_lr)
+    for it in range(opt.refine_iters):
+        optimizer.zero_grad()
+        total_loss = 0.0
+        for i, target in enumerate(targets):
+            position, look_at, up = camera_parameters_torch(
+                    rotation[i], translation, DISTANCE)
+            camera = pyredner.Camera(
+                    position     = position,
+                    look_at      = look_at,
+                    up           = up,
+                    fov          = torch.tensor([FOV]),
+                    clip_near    = 1e-2,
+                    resolution   = (opt.refine_resolution, opt.refine_resolution),
+                    fisheye      = False)
+            scene = pyredner.Scene(camera, mesh.shapes, mesh.materials, [], None)
+            alpha = crop_to_bbox(render_alpha(scene, it), opt.refine_resolution)
+            loss = torch.mean((alpha - target) ** 2)
+            loss.backward()
+            total_loss += loss.item()
+        optimizer.step()
+        print('Refinement iteration {}\tloss {:.6f}'.format(
+                it, total_loss / len(targets)))
+    return rotation.detach().numpy()
 
-    best_pose = dict()
-    best_loss = float("inf")
+# Load pose bank, packing it on first use
+bank_class = BitPoseBank if opt.bit_packed else PoseBank
+bank = bank_class.load(opt.pose_bank_path, opt.resolution, opt.rebuild_bank)
 
-    key = get_fn(fpath)
-
-    print("Processing {}".format(key), end='\t')
-    for k, v in data.items():
-        pose_path = os.path.join(opt.pose_bank_path, '{}.png'.format(k))
-        pose_img = crop_and_rescale(imread(pose_path)[:,:,0:1])
+# Load images to estimate poses for
+fpath_list = get_child_paths(os.path.join(opt.dataroot, 'mask'))
+keys = [get_fn(fpath) for fpath in fpath_list]
+queries = load_masks(fpath_list, opt.resolution)
 
-        l2 = np.sum((image - pose_img)**2)
-        if l2 < best_loss:
-            best_pose['geo_rotation'] = [v['azimuth'], v['elevation'], 0.0]
-            best_loss = l2
+# Search all queries against the bank at once
+if opt.index:
+    index = PoseIndex.load(bank, opt.pose_bank_path, opt.index_dims,
+                           opt.index_samples, opt.rebuild_bank)
+    best_idx, best_loss = index.nearest(bank, queries, opt.top_k,
+                                        opt.index_candidates, opt.metric)
+elif opt.pyramid != '':
+    levels = [int(r) for r in opt.pyramid.split(',')]
+    survivors = [int(n) for n in opt.survivors.split(',')][:len(levels)]
+    search = PyramidSearch(bank, opt.pose_bank_path, levels, survivors,
+                           opt.rebuild_bank)
+    best_idx, best_loss = search.nearest(queries, opt.top_k, opt.metric)
+    print('Pyramid search pruned {:.2%} of the full resolution comparisons'\
+            .format(search.pruning_ratio()))
+else:
+    best_idx, best_loss = bank.nearest(queries, opt.top_k, opt.metric)
 
-    print("Best pose: {}".format(best_pose))
+best_pose_dict = dict()
+for key, indices, losses in zip(keys, best_idx, best_loss):
+    poses = [bank.poses[idx] for idx in indices]
+    best_pose = {'geo_rotation': [poses[0]['azimuth'], poses[0]['elevation'], 0.0]}
+    if opt.top_k > 1:
+        best_pose['candidates'] = [
+            {'geo_rotation': [v['azimuth'], v['elevation'], 0.0], 'loss': float(l)}
+            for v, l in zip(poses, losses)]
+    print("Processing {}\tBest pose: {}".format(key, best_pose['geo_rotation']))
     best_pose_dict[key] = best_pose
 
+# Refine retrieved poses on CPU, opt.refine_batch images per optimizer
+if opt.refine:
+    pyredner.set_use_gpu(False)
+    pyredner.set_device(torch.device('cpu'))
+    mesh = LearnMesh.load_pth(opt.geometry_path, torch.device('cpu'))
+    for start in range(0, len(keys), opt.refine_batch):
+        batch_keys = keys[start:start + opt.refine_batch]
+        targets = [
+            crop_to_bbox(torch.tensor(imread(fpath)[:,:,0:1], dtype=torch.float32),
+                         opt.refine_resolution)
+            for fpath in fpath_list[start:start + opt.refine_batch]]
+        rotations = [best_pose_dict[key]['geo_rotation'] for key in batch_keys]
+        rotations = refine_poses(mesh, targets, rotations)
+        for key, rotation in zip(batch_keys, rotations):
+            best_pose_dict[key]['bank_rotation'] = best_pose_dict[key]['geo_rotation']
+            best_pose_dict[key]['geo_rotation'] = rotation.tolist()
+
 with open(os.path.join(opt.dataroot, 'poses.json'), 'w') as metafile:
     json.dump(best_pose_dict, metafile)
@@ -1,16 +1,32 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import os
 import subprocess
 from tempfile import NamedTemporaryFile
+import threading
 
+import numpy as np
+
+from util.gbuffer_util import GbufferStore, MASK_CHANNELS, NORMAL_CHANNELS, POSITION_CHANNELS
+from util.image_util import imwrite
 from util.misc_util import *
+from util.process_util import run_parallel
+from util.raster_util import load_obj, rasterize_uv
 
 
 MODELS_PATH = './datasets/meshes/full'
 LEARN_MODELS_PATH = './datasets/meshes/learn'
 
+GBUFFER_ROOT = './datasets/gbuffers'
 POSITION_PATH = './datasets/gbuffers/position'
 NORMAL_PATH = './datasets/gbuffers/normal'
 MASK_PATH = './datasets/gbuffers/mask'
+OUTPUT_PATHS = {'position': POSITION_PATH, 'normal': NORMAL_PATH, 'mask': MASK_PATH}
+
+# obj2pbrt conversions keyed by the hash of the OBJ and its materials
+PBRT_CACHE_PATH = './datasets/gbuffers/pbrt_cache'
 
 SCENE_TEMPLATE = """
 LookAt 0 0 0  0 1 0  1 0 0
@@ -30,26 +46,126 @@ AttributeEnd
 WorldEnd
 """
 
-def obj2pbrt(objpath):
-    model_pbrt = NamedTemporaryFile(delete=False)
-    with open(os.devnull, 'w') as devnull:
-        subprocess.run(['obj2pbrt', objpath, model_pbrt.name], stdout=devnull)
-    return model_pbrt.name
+# Serializes conversions of the same OBJ across render threads
+convert_locks = defaultdict(threading.Lock)
+convert_locks_guard = threading.Lock()
+
+def obj_digest(objpath):
+    # Content hash of an OBJ and the material libraries it references
+    sha = hashlib.sha256()
+    with open(objpath, 'rb') as f:
+        data = f.read()
+    sha.update(data)
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        tokens = line.split()
+        if len(tokens) < 2 or tokens[0] != 'mtllib':
+            continue
+        for name in tokens[1:]:
+            mtlpath = os.path.join(os.path.dirname(objpath), name)
+            sha.update(name.encode('utf-8'))
+            if os.path.exists(mtlpath):
+                with open(mtlpath, 'rb') as f:
+                    sha.update(f.read())
+    return sha.hexdigest()
+
+def obj2pbrt(objpath, digest):
+    model_pbrt = os.path.join(PBRT_CACHE_PATH, f'{digest}.pbrt')
+    with convert_locks_guard:
+        convert_lock = convert_locks[digest]
+    with convert_lock:
+        if not os.path.exists(model_pbrt):
+            os.makedirs(PBRT_CACHE_PATH, exist_ok=True)
+            # Convert next to the cache entry and move it in place once done
+            tmp = NamedTemporaryFile(dir=PBRT_CACHE_PATH, suffix='.pbrt', delete=False)
+            tmp.close()
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.run(['obj2pbrt', objpath, tmp.name],
+                                   stdout=devnull, check=True)
+                os.replace(tmp.name, model_pbrt)
+            finally:
+                if os.path.exists(tmp.name):
+                    os.remove(tmp.name)
+    return model_pbrt
 
 def render_scene(input_path, output_path, resolution, integrator):
+    # Renders to a temporary image first so interrupted renders are never
+    # mistaken for up to date outputs
     with open(os.devnull, 'w') as devnull:
+        # NOTE: pbrt resolves Include paths against the directory of the
+        #       temporary scene file, so all paths are made absolute
         scene_desc = SCENE_TEMPLATE.format(
-                input_path = input_path,
-                output_path = output_path,
+                input_path = os.path.abspath(input_path),
+                output_path = os.path.abspath(f'{output_path}.tmp'),
                 resolution = resolution,
                 integrator = integrator)
-        scene_pbrt = NamedTemporaryFile(delete=False)
-        scene_pbrt.write(scene_desc.encode('utf-8'))
-        scene_pbrt.close()
-        subprocess.run(['pbrt', scene_pbrt.name], stdout=devnull)
+        scene_pbrt = NamedTemporaryFile(suffix='.pbrt', delete=False)
+        try:
+            scene_pbrt.write(scene_desc.encode('utf-8'))
+            scene_pbrt.close()
+            subprocess.run(['pbrt', scene_pbrt.name], stdout=devnull, check=True)
+            os.replace(f'{output_path}.tmp.png', f'{output_path}.png')
+        finally:
+            os.remove(scene_pbrt.name)
     return
 
+def is_stale(output_path, input_path):
+    return not os.path.exists(output_path) or\
+           os.path.getmtime(output_path) <= os.path.getmtime(input_path)
+
+def render_pbrt(job):
+    # Renders one G-buffer of a mesh, pbrt runs as a subprocess
+    path, digest, integrator, resolution = job
+    model_pbrt = obj2pbrt(path, digest)
+    output_path = os.path.join(OUTPUT_PATHS[integrator], get_fn(path))
+    render_scene(model_pbrt, output_path, resolution, integrator)
+    return f'{integrator} for {path}'
+
+def render_raster(job):
+    # Renders the requested G-buffers of a mesh in a single rasterization and
+    # returns the packed ones at store precision
+    path, integrators, packed, resolution = job
+    buffers = dict(zip(['position', 'normal', 'mask'],
+                       rasterize_uv(load_obj(path), resolution)))
+    for integrator in integrators:
+        output_path = os.path.join(OUTPUT_PATHS[integrator], f'{get_fn(path)}.png')
+        imwrite(buffers[integrator], output_path)
+    return path, integrators, {c: buffers[c].astype(np.float16) for c in packed}
+
+def render_raster_jobs(jobs):
+    for job in jobs:
+        yield render_raster(job)
+
+def previous_raster_store(resolution):
+    # Store packed by an earlier raster run at the same resolution, if any
+    try:
+        store = GbufferStore.load(GBUFFER_ROOT)
+    except FileNotFoundError:
+        return None
+    if store.source != 'raster' or len(store) == 0 or\
+       store.buffers.shape[1:3] != (resolution, resolution):
+        return None
+    return store
+
+def raster_gbuffer(name, gbuffers, previous):
+    # (H, W, 7) G-buffer of a mesh from the buffers rasterized in this run,
+    # channels that were not rasterized come from the previous store
+    rasterized = gbuffers.get(name, dict())
+    return np.concatenate([
+        rasterized[c] if c in rasterized else previous[name][channels]
+        for c, channels in [('position', POSITION_CHANNELS),
+                            ('normal', NORMAL_CHANNELS),
+                            ('mask', MASK_CHANNELS)]], axis=-1)
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', type=str, default='pbrt', help='G-buffer renderer [pbrt | raster]')
+    parser.add_argument('--resolution', type=int, default=256, help='G-buffer resolution')
+    parser.add_argument('--workers', type=int, default=0, help='Number of concurrent pbrt renders or raster processes, 0 renders in this process')
+    parser.add_argument('--overwrite', action='store_true', help='Re-render G-buffers that are newer than their mesh')
+    parser.add_argument('--store', action='store_true', help='Also pack all G-buffers into a float16 G-buffer store, the raster backend packs them at full precision')
+    opt = parser.parse_args()
+
     model_paths = get_child_paths(MODELS_PATH, 'obj')
     learn_model_paths = get_child_paths(LEARN_MODELS_PATH, 'obj')
 
@@ -60,27 +176,63 @@ def main():
     if not os.path.exists(MASK_PATH):
         os.makedirs(MASK_PATH)
 
-    for path in learn_model_paths:
-        print(f"Rendering learn mask for {path}")
-        # convert obj to pbrt
-        learn_model_pbrt = obj2pbrt(path)
-
-        # render mask image
-        mask_path = os.path.join(MASK_PATH, get_fn(path))
-        render_scene(learn_model_pbrt, mask_path, 256, 'mask')
-
-    for path in model_paths:
-        print(f"Rendering gbuffer for {path}")
-        # convert obj to pbrt
-        model_pbrt = obj2pbrt(path)
-
-        # render position image
-        position_path = os.path.join(POSITION_PATH, get_fn(path))
-        render_scene(model_pbrt, position_path, 256, 'position')
-
-        # render normal image
-        normal_path = os.path.join(NORMAL_PATH, get_fn(path))
-        render_scene(model_pbrt, normal_path, 256, 'normal')
+    # Learn meshes provide the mask, full meshes the position and normal
+    meshes = list()
+    for paths, integrators in [(learn_model_paths, ['mask']),
+                               (model_paths, ['position', 'normal'])]:
+        for path in paths:
+            outputs = [
+                integrator for integrator in integrators
+                if opt.overwrite or is_stale(os.path.join(
+                    OUTPUT_PATHS[integrator], f'{get_fn(path)}.png'), path)]
+            meshes.append((path, integrators, outputs))
+    stale = [(path, outputs) for path, _, outputs in meshes if len(outputs) > 0]
+    print(f"Rendering {sum(len(i) for _, i in stale)} G-buffers")
+
+    if opt.backend == 'pbrt':
+        # Hash every mesh once, all of its integrator jobs share the conversion
+        digests = {path: obj_digest(path) for path, _ in stale}
+        jobs = [(path, digests[path], integrator, opt.resolution)
+                for path, integrators in stale for integrator in integrators]
+        with ThreadPoolExecutor(max(1, opt.workers)) as executor:
+            futures = [executor.submit(render_pbrt, job) for job in jobs]
+            for future in as_completed(futures):
+                print(f"Rendered {future.result()}")
+        if opt.store:
+            store = GbufferStore.pack_pngs(GBUFFER_ROOT)
+            print(f"Packed {len(store)} G-buffers into the G-buffer store")
+        return
+
+    # With --store every mesh is rasterized at most once: the pass that
+    # writes its PNGs also returns its store channels, and meshes whose
+    # previous store row is newer than the mesh are not rasterized at all
+    previous = previous_raster_store(opt.resolution) if opt.store else None
+    buffers_path, _ = GbufferStore.store_paths(GBUFFER_ROOT)
+    jobs = list()
+    for path, integrators, outputs in meshes:
+        reuse = previous is not None and get_fn(path) in previous and\
+                not is_stale(buffers_path, path)
+        packed = integrators if opt.store and not reuse else []
+        if len(outputs) > 0 or len(packed) > 0:
+            jobs.append((path, outputs, packed, opt.resolution))
+
+    if opt.workers > 0:
+        results = run_parallel(render_raster_jobs, (), jobs,
+                               opt.workers, 'Raster worker')
+    else:
+        results = render_raster_jobs(jobs)
+    gbuffers = defaultdict(dict)
+    for path, outputs, buffers in results:
+        if len(outputs) > 0:
+            print(f"Rendered {', '.join(outputs)} for {path}")
+        gbuffers[get_fn(path)].update(buffers)
+
+    if opt.store:
+        names = sorted(set(get_fn(p) for p in model_paths) &
+                       set(get_fn(p) for p in learn_model_paths))
+        store = GbufferStore.write(GBUFFER_ROOT, names,
+                lambda name: raster_gbuffer(name, gbuffers, previous), 'raster')
+        print(f"Packed {len(store)} G-buffers into the G-buffer store")
 
 
 if __name__ == '__main__':
@@ -3,31 +3,174 @@ import json
 import math
 import os
 
+import numpy as np
+from scipy.spatial import cKDTree
 import torch
 
 import redner
 import pyredner
 
 from util.geometry_util import camera_parameters
-from util.image_util import imread, imwrite
+from util.image_util import AsyncImageWriter, imread
 from util.misc_util import *
+from util.process_util import run_parallel
+from util.raster_util import render_silhouettes, stack_cameras
 
 
-# Argparser
-parser = argparse.ArgumentParser()
-parser.add_argument('--models_path', type=str, default='./datasets/meshes/one', help='Model path for mesh to render')
-parser.add_argument('--resolution', type=int, default=256, help='Resolution')
-parser.add_argument('--num_elev', type=int, default=50, help='Number of samples along azimuth parameter')
-parser.add_argument('--min_elev', type=float, default=0.0, help='Minimum elevation')
-parser.add_argument('--max_elev', type=float, default=math.pi/8.0, help='Maximum elevation')
-parser.add_argument('--gpu_id', type=int, default=0, help='GPU id to use')
-opt = parser.parse_args()
+# Object pose parameters
+TRANSLATION = [0.0, -0.75, 0.0]
+UP = [0.0, 1.0, 0.0]
+DISTANCE = 7.0
+FOV = 45.0
 
+# Golden angle used to spread fibonacci poses in azimuth
+GOLDEN_ANGLE = math.pi * (3.0 - math.sqrt(5.0))
+# Number of random view directions used to measure pose coverage
+NUM_GAP_PROBES = 100000
 
-def generate_poses(model_path, output_path):
-    # Init logger
-    log = dict()
 
+def main():
+    # Argparser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models_path', type=str, default='./datasets/meshes/one', help='Model path for mesh to render')
+    parser.add_argument('--output_path', type=str, default='./datasets/poses', help='Root directory for the per model pose banks')
+    parser.add_argument('--resolution', type=int, default=256, help='Resolution')
+    parser.add_argument('--sampling', type=str, default='grid', help='Pose sampling scheme [grid | fibonacci]')
+    parser.add_argument('--num_elev', type=int, default=50, help='Number of samples along azimuth parameter, grid sampling only')
+    parser.add_argument('--angular_res', type=float, default=2.0, help='Target spacing between neighbouring poses in degrees, fibonacci sampling only')
+    parser.add_argument('--min_elev', type=float, default=0.0, help='Minimum elevation')
+    parser.add_argument('--max_elev', type=float, default=math.pi/8.0, help='Maximum elevation')
+    parser.add_argument('--rasterizer', type=str, default='redner', help='Silhouette renderer [redner | torch], torch rasterizes a whole ring at once')
+    parser.add_argument('--gpu_id', type=int, default=0, help='GPU id to use')
+    parser.add_argument('--workers', type=int, default=0, help='Number of render processes, 0 renders in this process')
+    opt = parser.parse_args()
+
+    # Generate poses
+    paths = get_child_paths(opt.models_path)
+    paths = list(filter(lambda p: get_ext(p) == 'obj', paths))
+
+    rings = generate_poses(opt)
+    poses = [pose for ring in rings for pose in ring]
+    print('Sampled {} poses per model, max angular gap {:.3f} degrees'\
+            .format(len(poses), math.degrees(max_angular_gap(poses, opt))))
+    # Poses closer than the key precision would overwrite each other's masks
+    assert len(set(pose_key(*pose) for pose in poses)) == len(poses), \
+        'Pose keys are not unique, lower the sampling density'
+
+    # One job per (model, elevation ring), skipping poses a previous run
+    # already recorded in the model's data.json
+    logs = dict()
+    jobs = list()
+    for path in paths:
+        poses_dir = os.path.join(opt.output_path, get_fn(path))
+        if not os.path.exists(poses_dir):
+            os.makedirs(poses_dir)
+
+        logs[poses_dir] = load_log(poses_dir)
+        done = set(pose_key(v['elevation'], v['azimuth'])
+                   for v in logs[poses_dir].values())
+        for ring in rings:
+            ring = [pose for pose in ring if pose_key(*pose) not in done]
+            if len(ring) > 0:
+                jobs.append((path, poses_dir, ring))
+        num_poses = sum(len(job[2]) for job in jobs if job[1] == poses_dir)
+        print('Generating {} poses for {}'.format(num_poses, path))
+
+    if opt.workers > 0:
+        # Jobs are sorted by model, so workers mostly keep their loaded scene
+        results = run_parallel(render_jobs, (opt,), jobs,
+                               opt.workers, 'Pose bank worker')
+    else:
+        results = render_jobs(opt, jobs)
+    for poses_dir, log in results:
+        # Rewrite data.json after every job so interrupted runs can resume
+        logs[poses_dir].update(log)
+        json_path = os.path.join(poses_dir, 'data.json')
+        with open(json_path + '.tmp', 'w') as f:
+            json.dump(logs[poses_dir], f)
+        os.replace(json_path + '.tmp', json_path)
+
+def generate_poses(opt):
+    if opt.sampling == 'grid':
+        return grid_poses(opt)
+    elif opt.sampling == 'fibonacci':
+        return fibonacci_poses(opt)
+    else:
+        raise ValueError(f'Unknown pose sampling: {opt.sampling}')
+
+def grid_poses(opt):
+    # Elevation rings of (elevation, azimuth) poses
+    rings = list()
+    for i in range(opt.num_elev):
+        # Set elevation angle
+        elev_pc = i / opt.num_elev
+        elevation = opt.max_elev * elev_pc + opt.min_elev * (1 - elev_pc)
+
+        # Calculate number of azimuthal iterations
+        num_azimuth = int(opt.num_elev * math.sin(math.pi/2 - elevation))
+        rings.append([
+            (elevation, math.pi * 2 * j / num_azimuth)
+            for j in range(num_azimuth)])
+    return rings
+
+def fibonacci_poses(opt):
+    # Fibonacci lattice restricted to the elevation band: uniform in
+    # sin(elevation) and advancing by the golden angle in azimuth, so every
+    # pose covers roughly the same solid angle
+    delta = math.radians(opt.angular_res)
+    z_min, z_max = math.sin(opt.min_elev), math.sin(opt.max_elev)
+    # Band area over the area of a hexagonal cell with spacing delta
+    area = 2.0 * math.pi * (z_max - z_min)
+    num_poses = int(math.ceil(area / (math.sqrt(3.0) / 2.0 * delta ** 2)))
+
+    poses = list()
+    for i in range(num_poses):
+        z = z_min + (i + 0.5) / num_poses * (z_max - z_min)
+        poses.append((math.asin(z), (i * GOLDEN_ANGLE) % (2 * math.pi)))
+
+    # Chunk consecutive poses into bands of about delta in elevation
+    num_bands = max(1, int(math.ceil((opt.max_elev - opt.min_elev) / delta)))
+    bounds = np.linspace(0, num_poses, num_bands + 1).astype(int)
+    return [poses[start:end] for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start]
+
+def pose_directions(elevation, azimuth):
+    elevation, azimuth = np.asarray(elevation), np.asarray(azimuth)
+    return np.stack([
+        np.cos(elevation) * np.cos(azimuth),
+        np.cos(elevation) * np.sin(azimuth),
+        np.sin(elevation)], axis=-1)
+
+def max_angular_gap(poses, opt, seed=0):
+    # Largest angle between a random view direction in the elevation band
+    # and its nearest pose
+    rng = np.random.RandomState(seed)
+    z = rng.uniform(math.sin(opt.min_elev), math.sin(opt.max_elev), NUM_GAP_PROBES)
+    probes = pose_directions(np.arcsin(z),
+                             rng.uniform(0, 2 * math.pi, NUM_GAP_PROBES))
+    tree = cKDTree(pose_directions(*zip(*poses)))
+    chord, _ = tree.query(probes)
+    return 2.0 * np.arcsin(np.minimum(chord.max() / 2.0, 1.0))
+
+def pose_key(elevation, azimuth):
+    # Deterministic name so that reruns can recognize poses that were
+    # already rendered
+    return '{:.6f}_{:.6f}'.format(elevation, azimuth)
+
+def load_log(poses_dir):
+    path = os.path.join(poses_dir, 'data.json')
+    if not os.path.exists(path):
+        return dict()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def set_device(opt):
+    # Set Redner device
+    device = torch.device('cuda:{}'.format(opt.gpu_id) if opt.gpu_id != -1 else 'cpu')
+    pyredner.set_use_gpu(torch.cuda.is_available() and opt.gpu_id != -1)
+    pyredner.set_device(device)
+
+def load_scene(model_path, opt):
     # Load renderer configs
     material_map, mesh_list, light_map = pyredner.load_obj(model_path)
     material_id_map = {}
@@ -55,93 +198,81 @@ def generate_poses(model_path, output_path):
         dtype=torch.float32,
         device=pyredner.get_device()))
 
-    # Object pose parameters
-    euler_angles = [0.0, 0.0, 0.0]
-    translation = [0.0, -0.75, 0.0]
-    up = [0.0, 1.0, 0.0]
-    distance = 7.0
-
     # Setup base scene to modify during iterations
-    cam_params = camera_parameters(euler_angles, translation, distance, up)
+    camera = make_camera(0.0, 0.0, opt)
+    return pyredner.Scene(camera, shapes, materials,
+            area_lights = [], envmap = envmap)
 
-    camera = pyredner.Camera(
+def make_camera(elevation, azimuth, opt):
+    cam_params = camera_parameters(
+            [azimuth, elevation, 0.0], TRANSLATION, DISTANCE, UP)
+    return pyredner.Camera(
             position = torch.tensor(cam_params[0], dtype=torch.float32),
             look_at = torch.tensor(cam_params[1], dtype=torch.float32),
             up = torch.tensor(cam_params[2], dtype=torch.float32),
-            fov = torch.tensor([45.0]),
+            fov = torch.tensor([FOV]),
             clip_near = 1e-2,
             resolution = (opt.resolution, opt.resolution),
             fisheye = False)
 
-    scene = pyredner.Scene(camera, shapes, materials,
-            area_lights = [], envmap = envmap)
-
-    # Generate alphamasks
-    for i in range(opt.num_elev):
-        # Set elevation angle
-        elev_pc = i / opt.num_elev
-        elevation = opt.max_elev * elev_pc + opt.min_elev * (1 - elev_pc)
-        euler_angles[1] = elevation
+def render_poses(scene, poses, output_path, writer, opt):
+    # Generate alphamasks, only the camera changes between poses
+    log = dict()
+    for elevation, azimuth in poses:
+        print('Params: Elevation - {:.4f}\tAzimuth - {:.4f}'\
+                .format(elevation, azimuth))
 
-        # Calculate number of azimuthal iterations
-        num_azimuth = int(opt.num_elev * math.sin(math.pi/2 - elevation))
-        for j in range(num_azimuth):
-            # Set azimuthal angle
-            azimuth_pc = j / num_azimuth
-            azimuth = math.pi * 2 * azimuth_pc
-
-            euler_angles[0] = azimuth
-
-            print('Params: Elevation - {:.4f}\tAzimuth - {:.4f}'\
-                    .format(elevation, azimuth))
-
-            # Set Camera params
-            cam_params = camera_parameters(euler_angles, translation, distance, up)
-
-            # Update scene params
-            scene.camera = pyredner.Camera(
-                position = torch.tensor(cam_params[0], dtype=torch.float32),
-                look_at = torch.tensor(cam_params[1], dtype=torch.float32),
-                up = torch.tensor(cam_params[2], dtype=torch.float32),
-                fov = torch.tensor([45.0]),
-                clip_near = 1e-2,
-                resolution = (opt.resolution, opt.resolution),
-                fisheye = False
-            )
-            args = pyredner.RenderFunction.serialize_scene(
-                scene = scene,
-                num_samples = 1,
-                max_bounces = 1,
-                channels = [redner.channels.alpha])
-
-            out = pyredner.RenderFunction.apply(1, *args)
-
-            fn = gen_hash(6)
-            imwrite(out, os.path.join(output_path, '{}.png'.format(fn)))
-            log[fn] = {
-                'elevation': elevation,
-                'azimuth': azimuth
-            }
-    return log
+        scene.camera = make_camera(elevation, azimuth, opt)
+        args = pyredner.RenderFunction.serialize_scene(
+            scene = scene,
+            num_samples = 1,
+            max_bounces = 1,
+            channels = [redner.channels.alpha])
 
-# Set Redner device
-device = torch.device('cuda:{}'.format(opt.gpu_id) if opt.gpu_id != -1 else 'cpu')
-pyredner.set_use_gpu(torch.cuda.is_available())
-pyredner.set_device(device)
+        out = pyredner.RenderFunction.apply(1, *args)
 
-# Generate poses
-paths = get_child_paths(opt.models_path)
-paths = list(filter(lambda p: get_ext(p) == 'obj', paths))
+        fn = pose_key(elevation, azimuth)
+        writer.write(out, os.path.join(output_path, '{}.png'.format(fn)))
+        log[fn] = {
+            'elevation': elevation,
+            'azimuth': azimuth
+        }
+    return log
 
-for path in paths:
-    print('Generating poses for {}'.format(path))
+def rasterize_poses(scene, poses, output_path, writer, opt):
+    # Same as render_poses, but rasterizes all poses of a job in one batch
+    camera_params = [
+        camera_parameters([azimuth, elevation, 0.0], TRANSLATION, DISTANCE, UP)
+        for elevation, azimuth in poses]
+    cameras = stack_cameras(camera_params, pyredner.get_device())
+    out = render_silhouettes(scene.shapes, cameras, FOV,
+                             (opt.resolution, opt.resolution))
 
-    model_name = get_fn(path)
-    poses_dir = os.path.join('./datasets/poses', model_name)
+    log = dict()
+    for (elevation, azimuth), mask in zip(poses, out):
+        fn = pose_key(elevation, azimuth)
+        writer.write(mask, os.path.join(output_path, '{}.png'.format(fn)))
+        log[fn] = {
+            'elevation': elevation,
+            'azimuth': azimuth
+        }
+    return log
 
-    if not os.path.exists(poses_dir):
-        os.makedirs(poses_dir)
+def render_jobs(opt, jobs):
+    # Yields (output_path, log) once the masks of a job are on disk
+    set_device(opt)
+    scene_path, scene = None, None
+    with AsyncImageWriter() as writer:
+        for model_path, output_path, poses in jobs:
+            # Reuse the scene across the rings of a model
+            if model_path != scene_path:
+                scene_path, scene = model_path, load_scene(model_path, opt)
+            if opt.rasterizer == 'torch':
+                log = rasterize_poses(scene, poses, output_path, writer, opt)
+            else:
+                log = render_poses(scene, poses, output_path, writer, opt)
+            writer.flush()
+            yield output_path, log
 
-    log = generate_poses(path, poses_dir)
-    with open(os.path.join(poses_dir, 'data.json'), 'w') as f:
-        json.dump(log, f)
+if __name__ == '__main__':
+    main()
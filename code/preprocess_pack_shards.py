@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import skimage.io
+
+from util.image_util import imread
+from util.shard_util import ShardWriter
+
+
+def load_raw(path, dtype):
+    # uint8 shards keep the encoded PNG values, float16 shards linear ones
+    if dtype == 'uint8':
+        img = skimage.io.imread(path)
+        if img.ndim == 2:
+            img = img[:, :, None]
+        assert img.dtype == np.uint8, f'{path} is not an 8 bit image'
+        return img
+    return imread(path, dtype=np.float16)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', type=str, required=True,
+            help='Render directory with img/, mask/ and data.json')
+    parser.add_argument('--out_dir', type=str, default=None,
+            help='Shard directory, defaults to <dataroot>/shards')
+    parser.add_argument('--config_fn', type=str, default='data.json')
+    parser.add_argument('--dtype', type=str, default='uint8',
+            help='Storage type of images and masks [uint8 | float16]')
+    parser.add_argument('--shard_mb', type=int, default=256,
+            help='Approximate size of every shard file')
+    opt = parser.parse_args()
+
+    out_dir = opt.out_dir if opt.out_dir is not None \
+              else os.path.join(opt.dataroot, 'shards')
+
+    with open(os.path.join(opt.dataroot, opt.config_fn), 'r') as f:
+        configs = json.load(f)
+    keys = sorted(configs.keys())
+
+    writer = None
+    for i, key in enumerate(keys):
+        img = load_raw(os.path.join(opt.dataroot, 'img', f'{key}.png'), opt.dtype)
+        mask = load_raw(os.path.join(opt.dataroot, 'mask', f'{key}.png'), opt.dtype)
+        if writer is None:
+            writer = ShardWriter(out_dir, img.shape[:2], opt.dtype,
+                                 opt.shard_mb << 20)
+        writer.add(key, img[:, :, :3], mask[:, :, :1], configs[key])
+        if i % 1000 == 0:
+            print(f'Packed {i} / {len(keys)} renders')
+    if writer is not None:
+        writer.close()
+        print(f'Packed {len(keys)} renders into {len(writer.shards)} shards')
+
+    # Datasets and StableModel look up scene configs in <dataroot>/data.json
+    with open(os.path.join(out_dir, 'data.json'), 'w') as f:
+        json.dump(configs, f)
+
+if __name__ == '__main__':
+    main()
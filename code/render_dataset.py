@@ -1,15 +1,15 @@
 import argparse
 from datetime import datetime
-import json
 import os
 import time
 
-from skimage.transform import resize
 import torch
 
-from util.image_util import imread, imwrite
+from util.image_util import AsyncImageWriter
+from util.manifest_util import Manifest
 from util.misc_util import *
-from util.render_util import Render, RenderConfig
+from util.process_util import run_parallel
+from util.render_util import Render, RenderConfig, load_texture
 from util.sample_util import *
 
 
@@ -30,69 +30,112 @@ def main():
     parser.add_argument('--root_path', type=str, default='./datasets/renders/')
     parser.add_argument('--num_imgs', type=int, default=1000)
     parser.add_argument('--label', type=str, default='debug')
+    parser.add_argument('--out_dir', type=str, default=None,
+            help='Output directory, defaults to a timestamped subdirectory of root_path')
+    parser.add_argument('--resume', action='store_true',
+            help='Continue rendering into out_dir, skipping keys already in its manifest')
+    parser.add_argument('--compact', action='store_true',
+            help='Only rebuild data.json from the manifest in out_dir')
     # Misc
     parser.add_argument('--gpu_id', type=int, default=0,)
+    parser.add_argument('--workers', type=int, default=0,
+            help='Number of render processes, 0 renders in this process')
     opt = parser.parse_args()
 
     # Create Output directory
-    now = datetime.now()
-    subdir = f'{opt.label}_{now.month}-{now.day}-{now.hour}-{now.minute}'
-    out_path = os.path.join(opt.root_path, subdir)
+    if opt.out_dir is not None:
+        out_path = opt.out_dir
+    else:
+        assert(not opt.resume and not opt.compact)
+        now = datetime.now()
+        subdir = f'{opt.label}_{now.month}-{now.day}-{now.hour}-{now.minute}'
+        out_path = os.path.join(opt.root_path, subdir)
     if not os.path.exists(out_path):
         os.makedirs(out_path)
 
+    # Rendered scenes are appended to data.jsonl as they complete and
+    # compacted into the data.json the datasets read at the end
+    manifest = Manifest(os.path.join(out_path, 'data.jsonl'))
+    if opt.compact:
+        manifest.compact(os.path.join(out_path, 'data.json'))
+        return
+    if opt.resume:
+        done = manifest.load()
+        print(f'Resuming with {len(done)} rendered images')
+    else:
+        assert not os.path.exists(manifest.path), \
+            f'{manifest.path} exists, use --resume to continue it'
+        done = dict()
+
     # Load samplers
-    sampler = ConfigSampler({
-        'cam_rotation'       : HemisphereSamplerFactory(
-                                 [0.0, 0.5], [0.0, 0.0], [0.0, 0.0]),
-        'cam_translation'    : BoxSamplerFactory(
-                                 [-0.1, 0.1], [-0.76, -0.74], [-0.1, 0.1]),
-        'cam_distance'       : ConstantSamplerFactory(7.0),
-        'cam_fov'            : ConstantSamplerFactory([45.0]),
-        'cam_resolution'     : ConstantSamplerFactory([256, 256]),
-        'geometry_path'      : PathSamplerFactory(opt.geometry_path, ext='pth'),
-        'tex_diffuse_color'  : RGBFileSamplerFactory(opt.diffuse_refl_path),
-        'tex_specular_color' : ConstantSamplerFactory([0.8, 0.8, 0.8]),
-        'envmap_path'        : PathSamplerFactory(opt.envmaps_path, ext='exr'),
-        'envmap_signal_mean' : ConstantSamplerFactory(0.5),
-        'envmap_rotation'    : ConstantSamplerFactory(0.0),
-        'opt_num_samples'    : ConstantSamplerFactory((200, 1)),
-        'opt_max_bounces'    : ConstantSamplerFactory(2),
-        'opt_channels_str'   : ConstantSamplerFactory(['radiance', 'alpha']),
-        'opt_render_seed'    : RandIntSamplerFactory(0, 1e6),
-    })
-
-    # Init renderer
-    device = torch.device(f'cuda:{opt.gpu_id}' if opt.gpu_id != -1 else 'cpu')
-    config = RenderConfig()
-    renderer = Render(config, device)
+    sampler = SceneSamplerFactory(
+            opt.geometry_path, opt.envmaps_path, opt.diffuse_refl_path)
 
-    log = dict()
-    for i in range(opt.num_imgs):
-        # Generate render id and scene configs
+    # Generate render ids and scene configs
+    # NOTE: scenes carry their own opt_render_seed, so the output for a key
+    #       does not depend on which worker renders it
+    scenes = dict()
+    for i in range(opt.num_imgs - len(done)):
         key = gen_hash(6)
-        while key in log.keys():
-            key = gen_hash()
-        scene = sampler.generate()
-        log[key] = scene
-        config.set_scene(scene)
-
-        # Set texture for rendering
-        mesh_name = get_fn(config('geometry_path'))
-        texture = imread(os.path.join(opt.textures_path, f'{mesh_name}.png'))
-        texture = resize(texture, (opt.texture_size, opt.texture_size))
-        texture = torch.tensor(texture, dtype=torch.float32, device=device)
-
-        # Time Render operation
-        iter_start_time = time.time()
-        out = renderer(texture)
-        render_time = time.time() - iter_start_time
-        print(f'Generated Image: #\t{i} -- {key} in {render_time}')
-        imwrite(out[...,  : 3], os.path.join(out_path, 'img',  f'{key}.png'))
-        imwrite(out[..., 3: 4], os.path.join(out_path, 'mask', f'{key}.png'))
-
-        with open(os.path.join(out_path, 'data.json'), 'w') as metafile:
-            json.dump(log, metafile)
+        while key in scenes.keys() or key in done.keys():
+            key = gen_hash(6)
+        scenes[key] = sampler.generate()
+    jobs = list(scenes.items())
+
+    if opt.workers > 0:
+        # One Render per worker process, jobs are pulled from a shared queue
+        results = run_parallel(render_jobs, (opt, out_path), jobs,
+                               opt.workers, 'Render worker')
+    else:
+        results = render_jobs(opt, out_path, jobs)
+    with manifest:
+        for i, (key, render_time) in enumerate(results, len(done)):
+            print(f'Generated Image: #\t{i} -- {key} in {render_time}')
+            manifest.append(key, scenes[key])
+
+    manifest.compact(os.path.join(out_path, 'data.json'))
+
+def get_device(opt):
+    return torch.device(f'cuda:{opt.gpu_id}' if opt.gpu_id != -1 else 'cpu')
+
+def render_scene(renderer, config, writer, key, scene, opt, out_path):
+    config.set_scene(scene)
+
+    # Set texture for rendering
+    texture = load_texture(opt.textures_path, config('geometry_path'),
+                           opt.texture_size, renderer.device)
+
+    # Time Render operation
+    iter_start_time = time.time()
+    out = renderer(texture)
+    render_time = time.time() - iter_start_time
+    # Encoding overlaps with the next render
+    futures = [
+        writer.write(out[...,  : 3], os.path.join(out_path, 'img',  f'{key}.png')),
+        writer.write(out[..., 3: 4], os.path.join(out_path, 'mask', f'{key}.png')),
+    ]
+    return render_time, futures
+
+def render_jobs(opt, out_path, jobs):
+    # Yields (key, render_time) once both outputs of a key are on disk
+    config = RenderConfig()
+    renderer = Render(config, get_device(opt))
+    pending = list()
+    with AsyncImageWriter() as writer:
+        for key, scene in jobs:
+            render_time, futures = render_scene(
+                    renderer, config, writer, key, scene, opt, out_path)
+            pending.append((key, render_time, futures))
+            while len(pending) > 0 and all(f.done() for f in pending[0][2]):
+                key, render_time, futures = pending.pop(0)
+                for future in futures:
+                    future.result()
+                yield key, render_time
+        writer.flush()
+        for key, render_time, futures in pending:
+            for future in futures:
+                future.result()
+            yield key, render_time
 
 if __name__ == '__main__':
     main()
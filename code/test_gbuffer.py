@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+
+from preprocess_gen_gbuffer import LEARN_MODELS_PATH, MODELS_PATH, OUTPUT_PATHS
+from util.image_util import imread, imwrite
+from util.misc_util import get_child_paths, get_fn
+from util.raster_util import load_obj, rasterize_uv
+
+
+# Smallest coverage IoU against the pbrt G-buffers the rasterizer may reach
+min_iou = 0.98
+# Largest mean absolute difference of positions and encoded normals over
+# pixels covered in both
+max_error = 0.02
+
+# Compare against pbrt G-buffers rendered by preprocess_gen_gbuffer.py
+names = sorted(
+    set(get_fn(p) for p in get_child_paths(OUTPUT_PATHS['position'], 'png')) &
+    set(get_fn(p) for p in get_child_paths(OUTPUT_PATHS['normal'], 'png')) &
+    set(get_fn(p) for p in get_child_paths(OUTPUT_PATHS['mask'], 'png')))
+if len(names) == 0:
+    print('No pbrt G-buffers found, run preprocess_gen_gbuffer.py --backend pbrt')
+    sys.exit(1)
+
+failures = list()
+for name in names:
+    pbrt = {k: imread(os.path.join(OUTPUT_PATHS[k], f'{name}.png'))[:,:,:3]
+            for k in OUTPUT_PATHS}
+    resolution = pbrt['mask'].shape[0]
+
+    # Full meshes provide the position and normal, learn meshes the mask
+    position, normal, coverage = rasterize_uv(
+            load_obj(os.path.join(MODELS_PATH, f'{name}.obj')), resolution)
+    _, _, mask = rasterize_uv(
+            load_obj(os.path.join(LEARN_MODELS_PATH, f'{name}.obj')), resolution)
+
+    # pbrt leaves uncovered texels black
+    pbrt_coverage = pbrt['normal'].max(-1) > 0
+    pbrt_mask = pbrt['mask'][:,:,0] > 0.5
+    coverage, mask = coverage[:,:,0] > 0.5, mask[:,:,0] > 0.5
+    coverage_iou = (coverage & pbrt_coverage).sum() / max((coverage | pbrt_coverage).sum(), 1)
+    mask_iou = (mask & pbrt_mask).sum() / max((mask | pbrt_mask).sum(), 1)
+
+    both = coverage & pbrt_coverage
+    position_error = np.abs(position - pbrt['position'])[both].mean() if both.any() else 0.0
+    normal_error = np.abs(normal - pbrt['normal'])[both].mean() if both.any() else 0.0
+    print(f'{name}\tcoverage IoU {coverage_iou:.4f}\tmask IoU {mask_iou:.4f}\t'
+          f'position error {position_error:.4f}\tnormal error {normal_error:.4f}')
+    if min(coverage_iou, mask_iou) < min_iou or max(position_error, normal_error) > max_error:
+        failures.append(name)
+    imwrite(np.concatenate([position, pbrt['position']], axis=1), f'debug/test_gbuffer_{name}_position.png')
+    imwrite(np.concatenate([normal, pbrt['normal']], axis=1), f'debug/test_gbuffer_{name}_normal.png')
+
+if len(failures) > 0:
+    print(f'Meshes {failures} differ from their pbrt G-buffers')
+    sys.exit(1)
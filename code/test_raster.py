@@ -0,0 +1,63 @@
+import math
+import sys
+import time
+
+import torch
+
+import pyredner
+
+from util.geometry_util import camera_parameters
+from util.image_util import imwrite
+from util.raster_util import render_silhouettes, stack_cameras
+from util.render_util import LearnMesh, render_alpha
+
+
+device = torch.device('cpu')
+geometry_path = './datasets/meshes/serialized/octavia_clean.pth'
+resolution = (256, 256)
+fov = 45.0
+# Smallest per pose IoU against redner the rasterizer may reach
+min_iou = 0.98
+
+pyredner.set_use_gpu(False)
+pyredner.set_device(device)
+mesh = LearnMesh.load_pth(geometry_path, device)
+
+# Compare against redner's alpha over a ring of pose bank cameras
+poses = [(0.15, math.pi * 2 * j / 16) for j in range(16)]
+camera_params = [
+    camera_parameters([azimuth, elevation, 0.0], [0.0, -0.75, 0.0], 7.0)
+    for elevation, azimuth in poses]
+
+start_time = time.time()
+raster = render_silhouettes(mesh.shapes, stack_cameras(camera_params, device),
+                            fov, resolution)
+raster_time = time.time() - start_time
+
+redner_time = 0.0
+failures = list()
+for i, params in enumerate(camera_params):
+    camera = pyredner.Camera(
+            position = torch.tensor(params[0], dtype=torch.float32),
+            look_at = torch.tensor(params[1], dtype=torch.float32),
+            up = torch.tensor(params[2], dtype=torch.float32),
+            fov = torch.tensor([fov]),
+            clip_near = 1e-2,
+            resolution = resolution,
+            fisheye = False)
+    scene = pyredner.Scene(camera, mesh.shapes, mesh.materials, [], None)
+    start_time = time.time()
+    alpha = render_alpha(scene).detach() > 0.5
+    redner_time += time.time() - start_time
+
+    mask = raster[i] > 0.5
+    iou = (mask & alpha).sum().item() / max((mask | alpha).sum().item(), 1)
+    print(f'Pose {i}\tIoU {iou:.4f}')
+    if iou < min_iou:
+        failures.append(i)
+    imwrite(torch.cat([mask, alpha], dim=1).float(), f'debug/test_raster_{i}.png')
+
+print(f'Rasterizer {raster_time:.3f}s\tredner {redner_time:.3f}s')
+if len(failures) > 0:
+    print(f'Poses {failures} below IoU {min_iou}')
+    sys.exit(1)
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+import torch
+
+
+# Size in bytes of every tensor reachable from a (nested) container
+def tensor_nbytes(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in obj)
+    return 0
+
+
+class LRUCache(object):
+    # NOTE: Least recently used entries are evicted once either budget is
+    #       exceeded. A budget of None disables that bound.
+    def __init__(self, max_bytes=None, max_entries=None):
+        super(LRUCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, loader):
+        # loader() is only called on a miss and returns (value, size in bytes)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        value, size = loader()
+        self.entries[key] = (value, size)
+        self.num_bytes += size
+        self.evict()
+        return value
+
+    def evict(self):
+        while len(self.entries) > 0 and self.over_budget():
+            _, (_, size) = self.entries.popitem(last=False)
+            self.num_bytes -= size
+            self.evictions += 1
+
+    def over_budget(self):
+        if self.max_bytes is not None and self.num_bytes > self.max_bytes:
+            return True
+        if self.max_entries is not None and len(self.entries) > self.max_entries:
+            return True
+        return False
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.num_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,95 @@
+import json
+import os
+
+import numpy as np
+
+from .image_util import imread
+from .misc_util import get_child_paths, get_fn
+
+
+# Channel layout of the packed G-buffers
+POSITION_CHANNELS = slice(0, 3)
+NORMAL_CHANNELS = slice(3, 6)
+MASK_CHANNELS = slice(6, 7)
+NUM_CHANNELS = 7
+
+
+def load_png_gbuffer(gbuffer_root, name):
+    # (H, W, 7) position, normal and mask G-buffer from the PNG outputs of
+    # preprocess_gen_gbuffer.py
+    return np.concatenate([
+        imread(os.path.join(gbuffer_root, 'position', f'{name}.png')),
+        imread(os.path.join(gbuffer_root, 'normal', f'{name}.png')),
+        imread(os.path.join(gbuffer_root, 'mask', f'{name}.png'))[:,:,:1],
+    ], axis=-1)
+
+
+class GbufferStore(object):
+    # Position, normal and mask G-buffers of all meshes packed into a single
+    # (num_meshes, H, W, 7) float16 gbuffers.npy memory-mapped array, with a
+    # gbuffers.json index mapping mesh names to rows. source records what the
+    # rows were packed from, 'png' or 'raster'
+    def __init__(self, buffers, names, source=None):
+        super(GbufferStore, self).__init__()
+        self.buffers = buffers
+        self.names = names
+        self.source = source
+        self.index = {name: i for i, name in enumerate(names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        # Zero-copy (H, W, 7) view into the memory-mapped store
+        return self.buffers[self.index[name]]
+
+    @staticmethod
+    def store_paths(gbuffer_root):
+        prefix = os.path.join(gbuffer_root, 'gbuffers')
+        return prefix + '.npy', prefix + '.json'
+
+    @classmethod
+    def write(cls, gbuffer_root, names, load_fn, source=None):
+        # Packs load_fn(name) -> (H, W, 7) float G-buffers of the given meshes
+        buffers_path, index_path = cls.store_paths(gbuffer_root)
+        buffers = None
+        for i, name in enumerate(names):
+            gbuffer = load_fn(name)
+            if buffers is None:
+                buffers = np.lib.format.open_memmap(buffers_path + '.tmp',
+                        mode='w+', dtype=np.float16,
+                        shape=(len(names), *gbuffer.shape[:2], NUM_CHANNELS))
+            buffers[i] = gbuffer
+        if buffers is not None:
+            buffers.flush()
+            del buffers
+            os.replace(buffers_path + '.tmp', buffers_path)
+        with open(index_path, 'w') as f:
+            json.dump({'names': names, 'source': source}, f)
+        return cls.load(gbuffer_root)
+
+    @classmethod
+    def pack_pngs(cls, gbuffer_root):
+        # Packs every mesh that has all three PNG G-buffers
+        names = sorted(
+            set(get_fn(p) for p in get_child_paths(os.path.join(gbuffer_root, 'position'), 'png')) &
+            set(get_fn(p) for p in get_child_paths(os.path.join(gbuffer_root, 'normal'), 'png')) &
+            set(get_fn(p) for p in get_child_paths(os.path.join(gbuffer_root, 'mask'), 'png')))
+        return cls.write(gbuffer_root, names,
+                         lambda name: load_png_gbuffer(gbuffer_root, name), 'png')
+
+    @classmethod
+    def load(cls, gbuffer_root):
+        buffers_path, index_path = cls.store_paths(gbuffer_root)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(
+                    f'No G-buffer store in {gbuffer_root}, '
+                    'pack one with preprocess_gen_gbuffer.py --store')
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        names = index['names']
+        buffers = np.load(buffers_path, mmap_mode='r') if len(names) > 0 else None
+        return cls(buffers, names, index.get('source'))
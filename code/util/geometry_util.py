@@ -1,6 +1,7 @@
 import math
 
 import numpy as np
+import torch
 
 # Object transformation -> Camera Transformation
 def camera_parameters(euler_angles, translation, distance, up=(0.0, 1.0, 0.0)):
@@ -26,6 +27,30 @@ def camera_parameters(euler_angles, translation, distance, up=(0.0, 1.0, 0.0)):
              np.cross(np.cross(axis, up), axis) * math.cos(euler_angles[2])
     return (cam_position, cam_look_at, cam_up)
 
+# Differentiable version of camera_parameters for torch tensor inputs
+def camera_parameters_torch(euler_angles, translation, distance, up=(0.0, 1.0, 0.0)):
+    # Calculate Camera Position
+    cam_azim = -euler_angles[0]
+    cam_elev = math.pi/2 - euler_angles[1]
+    cam_pos_hat = torch.stack([
+        torch.cos(cam_azim)*torch.sin(cam_elev),
+        torch.cos(cam_elev),
+        torch.sin(cam_azim)*torch.sin(cam_elev)
+    ])
+    cam_position = cam_pos_hat * distance - translation
+
+    # Calculate Camera Look-at
+    cam_dir = -cam_pos_hat
+    cam_look_at = cam_position + cam_dir
+
+    # Calculate Camera Up direction
+    up = torch.tensor(up, dtype=cam_pos_hat.dtype, device=cam_pos_hat.device)
+    axis = -cam_pos_hat
+    cam_up = torch.dot(up, axis) * axis +\
+             torch.cross(axis, up, dim=0) * torch.sin(euler_angles[2]) +\
+             torch.cross(torch.cross(axis, up, dim=0), axis, dim=0) * torch.cos(euler_angles[2])
+    return (cam_position, cam_look_at, cam_up)
+
 def get_rotation_matrix_y(angle):
     cos= np.cos(angle)
     sin= np.sin(angle)
@@ -1,3 +1,7 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+
 import numpy as np
 import matplotlib
 import OpenEXR
@@ -11,8 +15,8 @@ import os
 
 def imwrite(img, filename, normalize = False):
     directory = os.path.dirname(filename)
-    if directory != '' and not os.path.exists(directory):
-        os.makedirs(directory)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
 
     if isinstance(img, torch.Tensor):
         img = img.cpu().data.numpy()
@@ -45,37 +49,134 @@ def imwrite(img, filename, normalize = False):
         img = (img * 255.0).astype('uint8')
         skimage.io.imsave(filename, img)
 
-def imread(filename):
+class AsyncImageWriter(object):
+    # Runs imwrite (gamma correction, quantization and encoding) on a thread
+    # pool. write() blocks once max_pending images are queued, and errors
+    # raised by a background write are re-raised by the next write(),
+    # flush() or close(). Pending writes are flushed on exit.
+    # NOTE: images are not copied, do not modify them after write()
+    def __init__(self, num_threads = 2, max_pending = 16):
+        super(AsyncImageWriter, self).__init__()
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.errors = list()
+        self.closed = False
+        atexit.register(self.close)
+
+    def write(self, img, filename, normalize = False):
+        self.check()
+        # Move tensors off the device on the calling thread
+        if isinstance(img, torch.Tensor):
+            img = img.detach().cpu().numpy()
+        self.slots.acquire()
+        future = self.executor.submit(imwrite, img, filename, normalize)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+        self.slots.release()
+
+    def check(self):
+        with self.lock:
+            errors, self.errors = self.errors, list()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def flush(self):
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        self.check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Decoding lookup tables keyed by (input dtype, output dtype, gamma)
+decode_luts = dict()
+
+def decode_lut(in_dtype, out_dtype, gamma):
+    # Value of every uint8 / uint16 code scaled to [0, 1] and raised to gamma
+    key = (np.dtype(in_dtype), np.dtype(out_dtype), gamma)
+    if key not in decode_luts:
+        max_value = np.iinfo(in_dtype).max
+        lut = np.arange(max_value + 1, dtype=np.float64) / max_value
+        decode_luts[key] = np.power(lut, gamma).astype(out_dtype)
+    return decode_luts[key]
+
+def read_exr(filename, window = None):
+    # Reads R, G and B in a single request, window = (x0, y0, x1, y1) reads
+    # the sub-window [x0, x1) x [y0, y1) of the data window
+    file = OpenEXR.InputFile(filename)
+    dw = file.header()['dataWindow']
+    width, height = dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1
+    x0, y0, x1, y1 = window if window is not None else (0, 0, width, height)
+    pt = Imath.PixelType(Imath.PixelType.FLOAT)
+    channels = file.channels(['R', 'G', 'B'], pt, dw.min.y + y0, dw.min.y + y1 - 1)
+    file.close()
+
+    img = np.empty((y1 - y0, x1 - x0, 3), dtype=np.float32)
+    for i, channel in enumerate(channels):
+        img[:, :, i] = np.frombuffer(channel, dtype=np.float32)\
+                         .reshape(y1 - y0, width)[:, x0:x1]
+    return img
+
+def imread(filename, window = None, dtype = np.float32):
     if (filename[-4:] == '.exr'):
-        file = OpenEXR.InputFile(filename)
-        dw = file.header()['dataWindow']
-        size = (dw.max.x - dw.min.x + 1, dw.max.y - dw.min.y + 1)
-        pt = Imath.PixelType(Imath.PixelType.FLOAT)
-        redstr = file.channel('R', pt)
-        red = np.fromstring(redstr, dtype = np.float32)
-        red.shape = (size[1], size[0])
-        greenstr = file.channel('G', pt)
-        green = np.fromstring(greenstr, dtype = np.float32)
-        green.shape = (size[1], size[0])
-        bluestr = file.channel('B', pt)
-        blue = np.fromstring(bluestr, dtype = np.float32)
-        blue.shape = (size[1], size[0])
-        return np.stack([red, green, blue], axis=-1).astype(np.float32)
+        return read_exr(filename, window).astype(dtype, copy=False)
     elif (filename[-4:] == '.hdr'):
         im = imageio.imread(filename)
     else:
         im = skimage.io.imread(filename)
 
+    if window is not None:
+        x0, y0, x1, y1 = window
+        im = im[y0:y1, x0:x1]
+
+    if im.dtype == np.uint8 or im.dtype == np.uint16:
+        # Linearize through lookup tables instead of float64 np.power calls
+        out = decode_lut(im.dtype, dtype, 2.2)[im]
+        if out.ndim == 2:
+            return np.repeat(out[:, :, None], 3, axis=-1)
+        elif out.shape[2] == 4:
+            out[:, :, 3] = decode_lut(im.dtype, dtype, 1.0)[im[:, :, 3]]
+        return out
+
     if im.ndim == 2:
         im = np.stack([im, im, im], axis=-1)
-        return np.power(skimage.img_as_float(im).astype(np.float32), 2.2)
+        return np.power(skimage.img_as_float(im).astype(dtype), 2.2)
     elif im.shape[2] == 4:
-        alpha = (im[:, :, 3] / 255.).astype(np.float32)
+        alpha = (im[:, :, 3] / 255.).astype(dtype)
         im = im[:, :, :3]
-        im = np.power(skimage.img_as_float(im).astype(np.float32), 2.2)
+        im = np.power(skimage.img_as_float(im).astype(dtype), 2.2)
         return np.dstack([im, alpha])
     else:
-        return np.power(skimage.img_as_float(im).astype(np.float32), 2.2)
+        return np.power(skimage.img_as_float(im).astype(dtype), 2.2)
+
+def imread_many(filenames, num_threads = 4, **kwargs):
+    # Decodes a list of images in parallel, EXR and PNG decoding release the GIL
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(lambda f: imread(f, **kwargs), filenames))
 
 # Not the best place for this function
 def grey2heatmap(image_torch, size):
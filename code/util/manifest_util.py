@@ -0,0 +1,67 @@
+import json
+import os
+
+
+class Manifest(object):
+    # Append-only JSON lines log of {"key": ..., "value": ...} records.
+    # Records are flushed as they are appended, so an interrupted run loses
+    # at most the line being written.
+    def __init__(self, path):
+        super(Manifest, self).__init__()
+        self.path = path
+        self.file = None
+
+    def load(self):
+        log = dict()
+        if not os.path.exists(self.path):
+            return log
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partial line left behind by an interrupted write
+                    continue
+                log[record['key']] = record['value']
+        return log
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Terminate a partial trailing line so new records start clean
+        needs_newline = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b'\n'
+        self.file = open(self.path, 'a')
+        if needs_newline:
+            self.file.write('\n')
+        return self
+
+    def append(self, key, value):
+        if self.file is None:
+            self.open()
+        self.file.write(json.dumps({'key': key, 'value': value}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def compact(self, json_path):
+        # Write the {key: value} dictionary the dataset loaders expect
+        log = self.load()
+        tmp_path = json_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(log, f)
+        os.replace(tmp_path, json_path)
+        return log
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,415 @@
+import json
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+import skimage
+import skimage.measure
+import skimage.transform
+
+from .image_util import imread
+
+
+# Crops an HWC mask to its bounding box and rescales it to a binary
+# (resolution, resolution) uint8 mask
+def crop_and_rescale(img, resolution):
+    img = img.astype('uint8')
+    props = skimage.measure.regionprops(img)
+    bbox = props[0].bbox
+    img = img[bbox[0]:bbox[3],bbox[1]:bbox[4],:]
+    img = skimage.transform.resize(img,
+        (resolution, resolution), order = 0)
+    return (img[:,:,0] > 0).astype('uint8')
+
+def load_masks(paths, resolution):
+    masks = np.zeros((len(paths), resolution * resolution), dtype=np.uint8)
+    for i, path in enumerate(paths):
+        masks[i] = crop_and_rescale(imread(path)[:,:,0:1], resolution).ravel()
+    return masks
+
+def load_bank_config(bank_path):
+    with open(os.path.join(bank_path, 'data.json'), 'r') as f:
+        poses = json.load(f)
+    return sorted(poses.keys()), poses
+
+def bank_config_mtime(bank_path):
+    # preprocess_generate_pose_bank.py rewrites data.json after every render,
+    # so its mtime changes whenever masks were re-rendered under the same keys
+    return os.stat(os.path.join(bank_path, 'data.json')).st_mtime_ns
+
+def bank_index_stale(index_path, keys, resolution, config_mtime):
+    if not os.path.exists(index_path):
+        return True
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    return index['keys'] != keys or index['resolution'] != resolution or \
+           index.get('config_mtime') != config_mtime
+
+def iter_bank_masks(bank_path, keys, resolution):
+    for key in keys:
+        path = os.path.join(bank_path, f'{key}.png')
+        yield crop_and_rescale(imread(path)[:,:,0:1], resolution).ravel()
+
+# Converts distances between binary masks with a points, b points and
+# a.b points in common into the metric used for ranking (lower is better)
+def mask_distance(a, b, inter, metric):
+    if metric == 'l2':
+        return a + b - 2 * inter
+    elif metric == 'iou':
+        union = np.maximum(a + b - inter, 1)
+        return 1 - inter / union
+    else:
+        raise NotImplementedError(f'Metric {metric} is not implemented')
+
+
+class PoseBank(object):
+    # Pose bank masks cropped, rescaled and packed once into a single
+    # (num_poses, resolution ** 2) uint8 array stored next to data.json
+    def __init__(self, masks, keys, poses, resolution):
+        super(PoseBank, self).__init__()
+        self.masks = masks
+        self.keys = keys
+        self.poses = poses
+        self.resolution = resolution
+        self.counts = np.asarray(masks.sum(axis=1, dtype=np.int64), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def packed_paths(bank_path, resolution):
+        prefix = os.path.join(bank_path, f'bank_{resolution}')
+        return prefix + '.npy', prefix + '.json'
+
+    @classmethod
+    def load(cls, bank_path, resolution, rebuild=False):
+        keys, poses = load_bank_config(bank_path)
+        config_mtime = bank_config_mtime(bank_path)
+        masks_path, index_path = cls.packed_paths(bank_path, resolution)
+
+        # Rebuild the packed bank when the pose bank changed
+        if rebuild or bank_index_stale(index_path, keys, resolution, config_mtime):
+            print(f'Packing pose bank {bank_path} at resolution {resolution}')
+            masks = np.lib.format.open_memmap(masks_path, mode='w+',
+                    dtype=np.uint8, shape=(len(keys), resolution * resolution))
+            for i, mask in enumerate(iter_bank_masks(bank_path, keys, resolution)):
+                masks[i] = mask
+            masks.flush()
+            del masks
+            with open(index_path, 'w') as f:
+                json.dump({'resolution': resolution, 'keys': keys,
+                           'config_mtime': config_mtime}, f)
+
+        masks = np.load(masks_path, mmap_mode='r')
+        return cls(masks, keys, [poses[k] for k in keys], resolution)
+
+    def nearest(self, queries, k=1, metric='l2', chunk_size=512):
+        # Squared L2 distances ||a||^2 + ||b||^2 - 2 a.b (or 1 - IoU) of all
+        # queries against the bank, evaluated in chunks of bank entries.
+        # Returns the indices and distances of the k nearest poses per query,
+        # closest first.
+        queries = np.asarray(queries, dtype=np.float32)
+        query_norms = np.sum(queries * queries, axis=1, keepdims=True)
+        best_idx = np.zeros((len(queries), 0), dtype=np.int64)
+        best_dist = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            chunk = np.asarray(self.masks[start:end], dtype=np.float32)
+            dist = mask_distance(query_norms, self.counts[start:end],
+                                 queries.dot(chunk.T), metric)
+            idx = np.broadcast_to(np.arange(start, end), dist.shape)
+            best_idx, best_dist = top_k(
+                    np.concatenate([best_idx, idx], axis=1),
+                    np.concatenate([best_dist, dist], axis=1), k)
+        return best_idx, best_dist
+
+    def distances(self, query, indices, metric='l2'):
+        # Exact distances of a single query against the given bank entries
+        query = np.asarray(query, dtype=np.float32)
+        rows = np.asarray(self.masks[indices], dtype=np.float32)
+        return mask_distance(np.sum(query * query), self.counts[indices],
+                             rows.dot(query), metric)
+
+
+class BitPoseBank(object):
+    # Pose bank masks packed to 1 bit per pixel in a single bank_<res>.bits
+    # file, with a bank_<res>.bits.json index holding the key order and the
+    # byte offset of every mask. Rows are padded to whole 64 bit words.
+    def __init__(self, bits, keys, poses, resolution):
+        super(BitPoseBank, self).__init__()
+        self.bits = bits
+        self.keys = keys
+        self.poses = poses
+        self.resolution = resolution
+        self.counts = popcount(bits).astype(np.float32)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def packed_paths(bank_path, resolution):
+        prefix = os.path.join(bank_path, f'bank_{resolution}.bits')
+        return prefix, prefix + '.json'
+
+    @classmethod
+    def load(cls, bank_path, resolution, rebuild=False):
+        keys, poses = load_bank_config(bank_path)
+        config_mtime = bank_config_mtime(bank_path)
+        bits_path, index_path = cls.packed_paths(bank_path, resolution)
+        row_bytes = packed_row_bytes(resolution * resolution)
+
+        if rebuild or bank_index_stale(index_path, keys, resolution, config_mtime):
+            print(f'Bit-packing pose bank {bank_path} at resolution {resolution}')
+            with open(bits_path, 'wb') as f:
+                for mask in iter_bank_masks(bank_path, keys, resolution):
+                    f.write(pack_masks(mask[np.newaxis]).tobytes())
+            with open(index_path, 'w') as f:
+                json.dump({
+                    'resolution': resolution,
+                    'keys': keys,
+                    'config_mtime': config_mtime,
+                    'row_bytes': row_bytes,
+                    'offsets': [i * row_bytes for i in range(len(keys))],
+                }, f)
+
+        bits = np.memmap(bits_path, dtype=np.uint8, mode='r',
+                         shape=(len(keys), row_bytes))
+        return cls(bits, keys, [poses[k] for k in keys], resolution)
+
+    def nearest(self, queries, k=1, metric='l2', chunk_size=4096):
+        # XOR/popcount kernel: for binary masks |a ^ b| = |a| + |b| - 2 |a & b|,
+        # which gives both the L2 distance and the IoU
+        queries = pack_masks(queries)
+        query_counts = popcount(queries).astype(np.float32)
+        best_idx = np.zeros((len(queries), 0), dtype=np.int64)
+        best_dist = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            chunk = np.asarray(self.bits[start:end])
+            counts = self.counts[start:end]
+            dist = np.zeros((len(queries), end - start), dtype=np.float32)
+            for i, query in enumerate(queries):
+                xor = popcount(np.bitwise_xor(chunk, query))
+                inter = (query_counts[i] + counts - xor) / 2
+                dist[i] = mask_distance(query_counts[i], counts, inter, metric)
+            idx = np.broadcast_to(np.arange(start, end), dist.shape)
+            best_idx, best_dist = top_k(
+                    np.concatenate([best_idx, idx], axis=1),
+                    np.concatenate([best_dist, dist], axis=1), k)
+        return best_idx, best_dist
+
+    def distances(self, query, indices, metric='l2'):
+        # Exact distances of a single query against the given bank entries
+        query = pack_masks(np.asarray(query)[np.newaxis])[0]
+        query_count = popcount(query).astype(np.float32)
+        counts = self.counts[indices]
+        xor = popcount(np.bitwise_xor(np.asarray(self.bits[indices]), query))
+        inter = (query_count + counts - xor) / 2
+        return mask_distance(query_count, counts, inter, metric)
+
+
+class PoseIndex(object):
+    # Approximate nearest neighbour index over a pose bank: masks are
+    # projected onto their leading principal components and the projections
+    # are searched with a KD-tree. Candidates are re-ranked exactly against
+    # the bank. Saved as bank_<res>.index.npz next to data.json.
+    # NOTE: KD-trees degrade to a linear scan beyond ~16 dimensions
+    def __init__(self, mean, components, projected, keys, resolution):
+        super(PoseIndex, self).__init__()
+        self.mean = mean
+        self.components = components
+        self.projected = projected
+        self.keys = keys
+        self.resolution = resolution
+        self.tree = cKDTree(projected)
+
+    @staticmethod
+    def index_path(bank_path, resolution):
+        return os.path.join(bank_path, f'bank_{resolution}.index.npz')
+
+    @classmethod
+    def build(cls, bank, dims=16, num_samples=4096, chunk_size=1024):
+        # PCA basis from a random subset of the bank
+        rng = np.random.RandomState(0)
+        sample = np.sort(rng.choice(len(bank), min(num_samples, len(bank)),
+                                    replace=False))
+        sample = bank_rows(bank, sample)
+        mean = sample.mean(axis=0)
+        sample = sample - mean
+
+        # Leading right singular vectors from the eigenvectors of the small
+        # (samples, samples) Gram matrix instead of a full thin SVD of the
+        # (samples, pixels) matrix: v = X^T u / sqrt(lambda)
+        eigvals, eigvecs = np.linalg.eigh(sample.dot(sample.T).astype(np.float64))
+        order = np.argsort(eigvals)[::-1][:dims]
+        order = order[eigvals[order] > 0]
+        components = sample.T.dot(eigvecs[:, order]) / np.sqrt(eigvals[order])
+        components = components.T.astype(np.float32)
+
+        projected = np.zeros((len(bank), len(components)), dtype=np.float32)
+        for start in range(0, len(bank), chunk_size):
+            end = min(start + chunk_size, len(bank))
+            rows = bank_rows(bank, np.arange(start, end))
+            projected[start:end] = (rows - mean).dot(components.T)
+        return cls(mean, components, projected, bank.keys, bank.resolution)
+
+    @classmethod
+    def load(cls, bank, bank_path, dims=16, num_samples=4096, rebuild=False):
+        path = cls.index_path(bank_path, bank.resolution)
+        config_mtime = bank_config_mtime(bank_path)
+        if not rebuild and os.path.exists(path):
+            data = np.load(path)
+            keys = [str(k) for k in data['keys']]
+            if keys == bank.keys and int(data['dims']) == dims and \
+               'num_samples' in data and int(data['num_samples']) == num_samples and \
+               'config_mtime' in data and int(data['config_mtime']) == config_mtime:
+                return cls(data['mean'], data['components'], data['projected'],
+                           keys, bank.resolution)
+        print(f'Building pose index for {bank_path} with {dims} dimensions')
+        index = cls.build(bank, dims, num_samples)
+        np.savez(path, mean=index.mean, components=index.components,
+                 projected=index.projected, keys=np.array(index.keys), dims=dims,
+                 num_samples=num_samples, config_mtime=config_mtime)
+        return index
+
+    def project(self, masks):
+        masks = np.asarray(masks, dtype=np.float32)
+        return (masks - self.mean).dot(self.components.T)
+
+    def query(self, masks, k=1):
+        # Top-k candidates per query and their distances in PCA space
+        k = min(k, len(self.keys))
+        dist, idx = self.tree.query(self.project(masks), k=k)
+        return np.reshape(idx, (len(masks), k)), np.reshape(dist, (len(masks), k))
+
+    def nearest(self, bank, queries, k=1, num_candidates=64, metric='l2'):
+        # Exact re-rank of the approximate candidates
+        candidates, _ = self.query(queries, max(k, num_candidates))
+        best_idx = np.zeros((len(queries), min(k, candidates.shape[1])), dtype=np.int64)
+        best_dist = np.zeros(best_idx.shape, dtype=np.float32)
+        for i, query in enumerate(queries):
+            dist = bank.distances(query, candidates[i], metric)
+            idx, dist = top_k(candidates[i:i+1], dist[np.newaxis], k)
+            best_idx[i], best_dist[i] = idx[0], dist[0]
+        return best_idx, best_dist
+
+
+class PyramidSearch(object):
+    # Coarse-to-fine search: candidates are ranked by L2 between downsampled
+    # masks at each pyramid level and only the best survivors are passed on
+    # to the next level. Survivors of the last level are ranked exactly at
+    # full resolution. The coarsest level of the bank is computed once and
+    # cached as bank_<res>.level_<r>.npy, finer levels are only computed for
+    # the survivors.
+    def __init__(self, bank, bank_path, levels, survivors, rebuild=False):
+        super(PyramidSearch, self).__init__()
+        assert(len(levels) == len(survivors))
+        assert(all(bank.resolution % r == 0 for r in levels))
+        self.bank = bank
+        self.levels = levels
+        self.survivors = survivors
+        self.coarse = self.load_level(bank_path, levels[0], rebuild)
+        # Number of pixel comparisons of the last search and of an exhaustive one
+        self.num_ops = 0
+        self.num_exhaustive_ops = 0
+
+    def load_level(self, bank_path, level, rebuild, chunk_size=1024):
+        bank = self.bank
+        path = os.path.join(bank_path, f'bank_{bank.resolution}.level_{level}.npy')
+        config_path = os.path.join(bank_path, 'data.json')
+        if not rebuild and os.path.exists(path) and \
+           os.path.getmtime(path) >= os.path.getmtime(config_path):
+            coarse = np.load(path)
+            if len(coarse) == len(bank):
+                return coarse
+        coarse = np.zeros((len(bank), level * level), dtype=np.float32)
+        for start in range(0, len(bank), chunk_size):
+            end = min(start + chunk_size, len(bank))
+            rows = bank_rows(bank, np.arange(start, end))
+            coarse[start:end] = downsample_masks(rows, bank.resolution, level)
+        np.save(path, coarse)
+        return coarse
+
+    def nearest(self, queries, k=1, metric='l2'):
+        bank = self.bank
+        queries = np.asarray(queries, dtype=np.float32)
+        self.num_ops = 0
+        self.num_exhaustive_ops = len(queries) * len(bank) * bank.resolution ** 2
+
+        # Coarsest level for all queries at once
+        level = self.levels[0]
+        coarse = downsample_masks(queries, bank.resolution, level)
+        dist = mask_distance(
+                np.sum(coarse * coarse, axis=1, keepdims=True),
+                np.sum(self.coarse * self.coarse, axis=1),
+                coarse.dot(self.coarse.T), 'l2')
+        candidates, _ = top_k(
+                np.broadcast_to(np.arange(len(bank)), dist.shape), dist,
+                self.survivors[0])
+        self.num_ops += len(queries) * len(bank) * level * level
+
+        best_idx = np.zeros((len(queries), min(k, candidates.shape[1])), dtype=np.int64)
+        best_dist = np.zeros(best_idx.shape, dtype=np.float32)
+        for i, query in enumerate(queries):
+            cand = candidates[i]
+            # Finer levels only for the survivors of the previous one
+            for level, keep in zip(self.levels[1:], self.survivors[1:]):
+                rows = downsample_masks(bank_rows(bank, cand), bank.resolution, level)
+                q = downsample_masks(query[np.newaxis], bank.resolution, level)[0]
+                dist = np.sum((rows - q) ** 2, axis=1)
+                cand, _ = top_k(cand[np.newaxis], dist[np.newaxis], keep)
+                cand = cand[0]
+                self.num_ops += len(rows) * level * level
+            # Exact ranking at full resolution
+            dist = bank.distances(query, cand, metric)
+            idx, dist = top_k(cand[np.newaxis], dist[np.newaxis], k)
+            best_idx[i], best_dist[i] = idx[0], dist[0]
+            self.num_ops += len(cand) * bank.resolution ** 2
+        return best_idx, best_dist
+
+    def pruning_ratio(self):
+        # Fraction of the exhaustive full resolution work skipped
+        return 1 - self.num_ops / max(self.num_exhaustive_ops, 1)
+
+
+# Block averages (N, resolution ** 2) masks down to (N, level ** 2)
+def downsample_masks(masks, resolution, level):
+    f = resolution // level
+    masks = np.asarray(masks, dtype=np.float32)
+    masks = masks.reshape(len(masks), level, f, level, f)
+    return masks.mean(axis=(2, 4)).reshape(len(masks), level * level)
+
+# Dense float32 rows of either pose bank format
+def bank_rows(bank, indices):
+    if isinstance(bank, BitPoseBank):
+        rows = np.unpackbits(np.asarray(bank.bits[indices]), axis=1)
+        return rows[:, :bank.resolution * bank.resolution].astype(np.float32)
+    return np.asarray(bank.masks[indices], dtype=np.float32)
+
+
+# Number of set bits for every 16 bit word
+POPCOUNT_16 = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+def packed_row_bytes(num_pixels):
+    return (num_pixels + 63) // 64 * 8
+
+# Packs (N, num_pixels) binary masks into (N, row_bytes) uint8 rows
+def pack_masks(masks):
+    masks = np.asarray(masks)
+    bits = np.packbits(masks > 0, axis=1)
+    padded = np.zeros((len(masks), packed_row_bytes(masks.shape[1])), dtype=np.uint8)
+    padded[:, :bits.shape[1]] = bits
+    return padded
+
+def popcount(bits):
+    bits = np.ascontiguousarray(bits)
+    return POPCOUNT_16[bits.view(np.uint16)].sum(axis=-1, dtype=np.int64)
+
+# Keeps the k smallest distances per row, sorted ascending
+def top_k(idx, dist, k):
+    if dist.shape[1] > k:
+        part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        idx = np.take_along_axis(idx, part, axis=1)
+        dist = np.take_along_axis(dist, part, axis=1)
+    order = np.argsort(dist, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(dist, order, axis=1)
@@ -0,0 +1,63 @@
+import multiprocessing as mp
+import queue
+import traceback
+
+
+# Seconds between liveness checks while waiting for worker results
+POLL_INTERVAL = 5.0
+
+
+def worker_loop(run_jobs, args, job_queue, result_queue):
+    # Feeds the queued jobs to run_jobs(*args, jobs) and forwards every
+    # result, or the traceback of the first failure
+    try:
+        jobs = iter(job_queue.get, None)
+        for result in run_jobs(*args, jobs):
+            result_queue.put((result, None))
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
+
+def run_parallel(run_jobs, args, jobs, num_workers, name='Worker'):
+    # Runs the generator run_jobs(*args, jobs) in spawned worker processes
+    # pulling jobs from a shared queue. run_jobs must be a module level
+    # function yielding one result per job, results are yielded in
+    # completion order. Worker exceptions, and workers dying without one
+    # (e.g. a native crash or an OOM kill), are raised as RuntimeError and
+    # remaining workers are terminated.
+    ctx = mp.get_context('spawn')
+    job_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(num_workers):
+        job_queue.put(None)
+
+    workers = [
+        ctx.Process(target=worker_loop,
+                    args=(run_jobs, args, job_queue, result_queue))
+        for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for _ in range(len(jobs)):
+            while True:
+                try:
+                    result, error = result_queue.get(timeout=POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    # Workers catch their exceptions and exit cleanly, a
+                    # non-zero exit code means the process was killed. With
+                    # results pending, all workers exiting means some were lost
+                    codes = [w.exitcode for w in workers if not w.is_alive()]
+                    if any(code != 0 for code in codes) or \
+                       len(codes) == len(workers):
+                        raise RuntimeError(
+                                f'{name} exited unexpectedly with codes {codes}')
+            if error is not None:
+                raise RuntimeError(f'{name} failed:\n{error}')
+            yield result
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
@@ -0,0 +1,224 @@
+import math
+
+import numpy as np
+import torch
+
+
+# Pixel bounding box sizes triangles are bucketed by before rasterization,
+# triangles larger than the last bucket are rasterized over the full image
+BBOX_BUCKETS = [2, 4, 8, 16, 32, 64]
+# Upper bound on the number of (triangle, pixel) pairs evaluated at once
+CHUNK_PIXELS = 1 << 22
+# Same for the numpy UV rasterizer, which keeps float64 barycentrics
+UV_CHUNK_PIXELS = 1 << 20
+
+
+def stack_cameras(camera_params, device=None):
+    # List of camera_parameters() tuples -> (position, look_at, up) (C, 3) tensors
+    return tuple(
+        torch.tensor([p[i] for p in camera_params], dtype=torch.float32, device=device)
+        for i in range(3))
+
+def project(vertices, cameras, fov, resolution):
+    # Projects (V, 3) vertices into C cameras following redner's perspective
+    # camera: returns (C, V, 2) pixel coordinates and (C, V) view depths
+    position, look_at, up = cameras
+    d = torch.nn.functional.normalize(look_at - position, dim=-1)
+    right = torch.nn.functional.normalize(torch.cross(d, up, dim=-1), dim=-1)
+    new_up = torch.cross(right, d, dim=-1)
+
+    rel = vertices[None] - position[:, None]
+    x = (rel * right[:, None]).sum(-1)
+    y = (rel * new_up[:, None]).sum(-1)
+    z = (rel * d[:, None]).sum(-1)
+
+    height, width = resolution
+    aspect = width / height
+    f = 1.0 / math.tan(math.radians(fov) / 2.0)
+    screen_x = (0.5 + 0.5 * f * x / z) * width
+    screen_y = (0.5 - 0.5 * f * y / z * aspect) * height
+    return torch.stack([screen_x, screen_y], dim=-1), z
+
+def edge_function(a, b, px, py):
+    # Works on torch tensors and numpy arrays alike
+    return (b[:, None, 0] - a[:, None, 0]) * (py - a[:, None, 1]) -\
+           (b[:, None, 1] - a[:, None, 1]) * (px - a[:, None, 0])
+
+def bucket_triangles(extent, max_size, chunk_pixels=CHUNK_PIXELS):
+    # Yields (size, indices) chunks of the triangles whose pixel bounding box
+    # extent fits in size x size, at most chunk_pixels pixels per chunk.
+    # Bucketing keeps small triangles, the vast majority on our meshes, from
+    # paying for the large ones. extent is a (T,) tensor or numpy array.
+    prev = 0
+    for size in BBOX_BUCKETS + [max_size]:
+        bucket = ((extent > prev) & (extent <= size)).nonzero()
+        bucket = bucket[0] if isinstance(bucket, tuple) else bucket[:, 0]
+        prev = size
+        chunk_size = max(1, chunk_pixels // (size * size))
+        for start in range(0, len(bucket), chunk_size):
+            yield size, bucket[start:start + chunk_size]
+
+def rasterize(tri, cam_idx, out, resolution):
+    # Marks pixel centers covered by (T, 3, 2) screen space triangles in the
+    # flattened (C * H * W,) boolean buffer out
+    height, width = resolution
+    lo = torch.ceil(tri.min(1)[0] - 0.5).long()
+    hi = torch.floor(tri.max(1)[0] - 0.5).long()
+    lo[:, 0].clamp_(0, width - 1)
+    lo[:, 1].clamp_(0, height - 1)
+    hi[:, 0].clamp_(max=width - 1)
+    hi[:, 1].clamp_(max=height - 1)
+    extent = (hi - lo + 1).max(1)[0]
+
+    grid_size = None
+    for size, idx in bucket_triangles(extent, max(height, width)):
+        if size != grid_size:
+            offset_y, offset_x = torch.meshgrid(
+                    torch.arange(size, device=tri.device),
+                    torch.arange(size, device=tri.device))
+            offset_x, offset_y = offset_x.reshape(-1), offset_y.reshape(-1)
+            grid_size = size
+
+        t, l, h = tri[idx], lo[idx], hi[idx]
+        px = l[:, 0:1] + offset_x
+        py = l[:, 1:2] + offset_y
+        cx, cy = px.float() + 0.5, py.float() + 0.5
+
+        e0 = edge_function(t[:, 0], t[:, 1], cx, cy)
+        e1 = edge_function(t[:, 1], t[:, 2], cx, cy)
+        e2 = edge_function(t[:, 2], t[:, 0], cx, cy)
+        # Silhouettes ignore winding, accept either orientation
+        inside = ((e0 >= 0) & (e1 >= 0) & (e2 >= 0)) |\
+                 ((e0 <= 0) & (e1 <= 0) & (e2 <= 0))
+        inside &= (px <= h[:, 0:1]) & (py <= h[:, 1:2])
+
+        flat = (cam_idx[idx, None] * height + py) * width + px
+        out[flat[inside]] = True
+
+def render_silhouettes(shapes, cameras, fov, resolution, clip_near=1e-2):
+    # Binary alpha masks of the shapes seen from a batch of cameras
+    #   shapes: objects with (V, 3) vertices and (F, 3) indices, e.g. LearnMesh.shapes
+    #   cameras: (position, look_at, up) (C, 3) tensors, see stack_cameras
+    # Returns (C, H, W, 1) float masks matching redner's alpha channel layout
+    height, width = resolution
+    num_cameras = cameras[0].shape[0]
+    device = cameras[0].device
+    out = torch.zeros(num_cameras * height * width, dtype=torch.bool, device=device)
+
+    with torch.no_grad():
+        for shape in shapes:
+            vertices = shape.vertices.to(device=device, dtype=torch.float32)
+            indices = shape.indices.to(device=device).long()
+            screen, depth = project(vertices, cameras, fov, resolution)
+
+            # Drop triangles crossing the near plane and degenerate ones
+            tri = screen[:, indices]
+            valid = (depth[:, indices] > clip_near).all(-1)
+            area = edge_function(tri[..., 0, :].reshape(-1, 2),
+                                 tri[..., 1, :].reshape(-1, 2),
+                                 tri[..., 2, 0].reshape(-1, 1),
+                                 tri[..., 2, 1].reshape(-1, 1))
+            valid &= area.view(valid.shape) != 0
+
+            cam_idx, face_idx = valid.nonzero(as_tuple=True)
+            if len(cam_idx) > 0:
+                rasterize(tri[cam_idx, face_idx], cam_idx, out, resolution)
+
+    return out.view(num_cameras, height, width, 1).float()
+
+def parse_corner(token, counts):
+    # OBJ face corner "v", "v/t", "v//n" or "v/t/n" -> zero based (v, t, n),
+    # -1 marks a missing attribute
+    corner = [-1, -1, -1]
+    for i, value in enumerate(token.split('/')[:3]):
+        if value != '':
+            value = int(value)
+            corner[i] = value - 1 if value > 0 else counts[i] + value
+    return corner
+
+def load_obj(path):
+    # Minimal OBJ reader, polygons are triangulated as fans
+    pools = ([], [], [])
+    faces = []
+    with open(path, 'r') as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) == 0:
+                continue
+            elif tokens[0] == 'v':
+                pools[0].append([float(x) for x in tokens[1:4]])
+            elif tokens[0] == 'vt':
+                pools[1].append([float(x) for x in tokens[1:3]])
+            elif tokens[0] == 'vn':
+                pools[2].append([float(x) for x in tokens[1:4]])
+            elif tokens[0] == 'f':
+                counts = [len(pool) for pool in pools]
+                corners = [parse_corner(t, counts) for t in tokens[1:]]
+                for i in range(1, len(corners) - 1):
+                    faces.append([corners[0], corners[i], corners[i + 1]])
+    positions = np.array(pools[0], dtype=np.float32).reshape(-1, 3)
+    uvs = np.array(pools[1], dtype=np.float32).reshape(-1, 2)
+    normals = np.array(pools[2], dtype=np.float32).reshape(-1, 3)
+    faces = np.array(faces, dtype=np.int64).reshape(-1, 3, 3)
+    return positions, uvs, normals, faces
+
+def rasterize_uv(obj, resolution):
+    # Rasterizes the mesh in texture space, pixel (x, y) = (u * W, (1 - v) * H),
+    # interpolating positions normalized to the mesh bounding box and normals
+    # encoded as 0.5 * n + 0.5 at pixel centers
+    positions, uvs, normals, faces = obj
+    faces = faces[(faces[:, :, 1] >= 0).all(1)]
+
+    tri_pos = positions[faces[:, :, 0]]
+    if len(normals) > 0 and (faces[:, :, 2] >= 0).all():
+        tri_nrm = normals[faces[:, :, 2]]
+    else:
+        # Fall back to flat face normals, taken before the non-uniform
+        # bounding box normalization below would skew them
+        face_nrm = np.cross(tri_pos[:, 1] - tri_pos[:, 0], tri_pos[:, 2] - tri_pos[:, 0])
+        tri_nrm = np.repeat(face_nrm[:, None], 3, axis=1)
+    lo, hi = positions.min(0), positions.max(0)
+    tri_pos = (tri_pos - lo) / np.maximum(hi - lo, 1e-8)
+    tri = uvs[faces[:, :, 1]] * [resolution, -resolution] + [0, resolution]
+
+    area = edge_function(tri[:, 0], tri[:, 1], tri[:, 2, 0:1], tri[:, 2, 1:2])[:, 0]
+    keep = area != 0
+    tri, tri_pos, tri_nrm, area = tri[keep], tri_pos[keep], tri_nrm[keep], area[keep]
+
+    position = np.zeros((resolution, resolution, 3), dtype=np.float32)
+    normal = np.zeros((resolution, resolution, 3), dtype=np.float32)
+    mask = np.zeros((resolution, resolution, 1), dtype=np.float32)
+
+    lo = np.clip(np.ceil(tri.min(1) - 0.5), 0, resolution - 1).astype(np.int64)
+    hi = np.minimum(np.floor(tri.max(1) - 0.5), resolution - 1).astype(np.int64)
+    extent = (hi - lo + 1).max(1)
+
+    grid_size = None
+    for size, idx in bucket_triangles(extent, resolution, UV_CHUNK_PIXELS):
+        if size != grid_size:
+            offset_y, offset_x = [o.reshape(-1) for o in np.mgrid[:size, :size]]
+            grid_size = size
+
+        t = tri[idx]
+        px = lo[idx, 0:1] + offset_x
+        py = lo[idx, 1:2] + offset_y
+        cx, cy = px + 0.5, py + 0.5
+
+        # Barycentric coordinates, normalized by the signed area so both
+        # windings end up positive inside the triangle
+        w0 = edge_function(t[:, 1], t[:, 2], cx, cy) / area[idx, None]
+        w1 = edge_function(t[:, 2], t[:, 0], cx, cy) / area[idx, None]
+        w2 = 1.0 - w0 - w1
+        inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0) &\
+                 (px <= hi[idx, 0:1]) & (py <= hi[idx, 1:2])
+
+        face, _ = np.nonzero(inside)
+        w = np.stack([w0[inside], w1[inside], w2[inside]], axis=-1)[:, :, None]
+        y, x = py[inside], px[inside]
+        position[y, x] = (w * tri_pos[idx][face]).sum(1)
+        n = (w * tri_nrm[idx][face]).sum(1)
+        normal[y, x] = n / np.maximum(np.linalg.norm(n, axis=-1, keepdims=True), 1e-8)
+        mask[y, x] = 1.0
+
+    normal = (0.5 * normal + 0.5) * mask
+    return position, normal, mask
@@ -4,16 +4,29 @@ import random
 
 import numpy as np
 
+from skimage.transform import resize
 import torch
+import torch.nn.functional as F
 
 import redner
 import pyredner
 
+from .cache_util import LRUCache, tensor_nbytes
 from .geometry_util import camera_parameters, get_rotation_matrix_y
 from .image_util import imread
 from .misc_util import *
 
 
+# Default byte budget for deserialized meshes kept alive by Render
+MESH_CACHE_BYTES = 2 * 1024 ** 3
+# Default number of prepared environment maps kept alive by Render
+ENVMAP_CACHE_ENTRIES = 16
+# Default byte budget for radiance transfer bakes kept alive by DeferredRender
+TRANSFER_CACHE_BYTES = 2 * 1024 ** 3
+# Buffers stored in a radiance transfer bake
+TRANSFER_BUFFERS = ['uv', 'base', 'irradiance', 'specular', 'alpha']
+
+
 class RenderConfig(object):
     def __init__(self):
         super(RenderConfig, self).__init__()
@@ -30,7 +43,9 @@ class RenderConfig(object):
 
 
 class Render(object):
-    def __init__(self, config, device, isTrain = False):
+    def __init__(self, config, device, isTrain = False,
+                 mesh_cache_bytes = MESH_CACHE_BYTES,
+                 envmap_cache_entries = ENVMAP_CACHE_ENTRIES):
         super(Render, self).__init__()
         # Initialize scene metadata config
         self.config = config
@@ -38,10 +53,40 @@ class Render(object):
 
         # Redner GPU Configs
         self.device = device
+        self.set_device()
+
+        # Deserialized meshes keyed by (path, device)
+        self.mesh_cache = LRUCache(max_bytes=mesh_cache_bytes)
+        # Prepared envmaps keyed by (path, signal mean, device)
+        self.envmap_cache = LRUCache(max_entries=envmap_cache_entries)
+
+    def load_mesh(self, path):
+        def loader():
+            state_dict = torch.load(path, map_location=self.device)
+            mesh = LearnMesh.load_state_dict(state_dict, self.device)
+            return mesh, tensor_nbytes(state_dict)
+        return self.mesh_cache.get((path, str(self.device)), loader)
+
+    def load_envmap(self, path, signal_mean, rangle):
+        # Decoding and importance sampling setup only happen on a miss,
+        # the rotation is applied to the shared envmap through env_to_world
+        def loader():
+            envmap = load_envmap(path, signal_mean, 0.0, self.device)
+            return envmap, tensor_nbytes(envmap.values.texels)
+        envmap = self.envmap_cache.get(
+                (path, signal_mean, str(self.device)), loader)
+        set_envmap_rotation(envmap, rangle)
+        return envmap
+
+    def set_device(self):
+        # pyredner keeps its device globally, reset it on every call so
+        # renderers on different devices can share a process
         pyredner.set_use_gpu(self.device != torch.device('cpu'))
         pyredner.set_device(self.device)
 
     def __call__(self, input):
+        self.set_device()
+
         ### Load active scene blob from config ###
 
         # Camera params
@@ -85,17 +130,18 @@ class Render(object):
                 fisheye      = False) # Hardcoded
 
         # Load geometry from specified path
-        mesh = LearnMesh.load_pth(geometry_path, self.device)
+        # NOTE: cached meshes are shared between calls, only the learnable
+        #       material slot is replaced below
+        mesh = self.load_mesh(geometry_path)
 
         # Set Learnable material
         mesh.set_learn_material(input, tex_diffuse_color, tex_specular_color)
 
         # Load envmap from specified path
-        envmap = load_envmap(
+        envmap = self.load_envmap(
                 envmap_path,
                 envmap_signal_mean,
-                envmap_rotation,
-                self.device)
+                envmap_rotation)
 
         # Convert channels list into redner primitives
         opt_channels = list()
@@ -125,6 +171,83 @@ class Render(object):
 
         return out
 
+class DeferredRender(object):
+    # Reconstructs renders from per-scene radiance transfer bakes written by
+    # preprocess_bake_transfer.py. With the learnable material sampled at the
+    # baked per-pixel uv coordinates the radiance is approximated as
+    #   base + irradiance * diffuse(uv) + specular * (1 - alpha(uv))
+    # which is differentiable w.r.t. the input texture through grid_sample.
+    # NOTE: Scenes are read from config('transfer_path'), all other scene
+    #       parameters (including envmap_rotation) are fixed by the bake
+    def __init__(self, config, device, isTrain = False,
+                 transfer_cache_bytes = TRANSFER_CACHE_BYTES):
+        super(DeferredRender, self).__init__()
+        self.config = config
+        self.isTrain = isTrain
+        self.device = device
+
+        # Transfer buffers keyed by (path, device)
+        self.transfer_cache = LRUCache(max_bytes=transfer_cache_bytes)
+
+    def load_transfer(self, path):
+        def loader():
+            bake = np.load(path)
+            transfer = {
+                k: torch.tensor(bake[k], dtype=torch.float32, device=self.device)
+                for k in TRANSFER_BUFFERS
+            }
+            return transfer, tensor_nbytes(transfer)
+        return self.transfer_cache.get((path, str(self.device)), loader)
+
+    def __call__(self, input):
+        assert(isinstance(input, torch.Tensor))
+        assert(input.shape[-1] == 3 or input.shape[-1] == 4)
+
+        transfer_path          = self.config('transfer_path')
+        tex_diffuse_color      = self.config('tex_diffuse_color')
+        opt_channels_str       = self.config('opt_channels_str')
+
+        # XXX: Temporary hack for training override
+        if self.isTrain:
+            opt_channels_str = ['radiance']
+
+        transfer = self.load_transfer(transfer_path)
+
+        # Sample texture at the baked uv coordinates
+        grid = transfer['uv'].unsqueeze(0) * 2 - 1
+        texture = input.permute(2, 0, 1).unsqueeze(0)
+        texels = F.grid_sample(texture, grid, mode='bilinear',
+                padding_mode='border', align_corners=False)
+        texels = texels[0].permute(1, 2, 0)
+
+        # Alpha composit learneable material as in LearnMesh.set_learn_material
+        if input.shape[-1] == 4:
+            diffuse = torch.tensor(tex_diffuse_color, dtype=torch.float32,
+                                   device=self.device)
+            diffuse = texels[:,:,-1:] * texels[:,:,:-1] + \
+                      (1 - texels[:,:,-1:]) * diffuse
+            specular_weight = 1 - texels[:,:,-1:]
+        else:
+            diffuse = texels
+            specular_weight = 1.0
+
+        radiance = transfer['base'] + \
+                   transfer['irradiance'] * diffuse + \
+                   transfer['specular'] * specular_weight
+
+        out = list()
+        for ch in opt_channels_str:
+            if ch == 'radiance':
+                out.append(radiance)
+            elif ch == 'alpha':
+                out.append(transfer['alpha'])
+            else:
+                raise NotImplementedError(
+                        f'Channel {ch} is not available in deferred mode')
+        out = torch.cat(out, dim=-1)
+
+        return torch.clamp(out, 0, 1)
+
 class LearnMesh(object):
     def __init__(self, materials, shapes, learn_tex_idx, device):
         self.materials = materials
@@ -226,6 +349,16 @@ class LearnMesh(object):
         return cls.load_state_dict(state_dict, device)
 
 
+# Cheap single sample alpha-only render, differentiable w.r.t. the camera
+# NOTE: keep the scene alive until backward, see Render.__call__
+def render_alpha(scene, seed = 0):
+    args = pyredner.RenderFunction.serialize_scene(
+            scene = scene,
+            num_samples = 1,
+            max_bounces = 1,
+            channels = [redner.channels.alpha])
+    return pyredner.RenderFunction.apply(seed, *args)
+
 # Envmap Loader
 def load_envmap(envmap_path, signal_mean, rangle, device):
     envmap = imread(envmap_path)
@@ -235,3 +368,16 @@ def load_envmap(envmap_path, signal_mean, rangle, device):
     return pyredner.EnvironmentMap(
             torch.tensor(envmap, dtype=torch.float32, device=device),
             env_to_world=env_to_world)
+
+# Texture of a mesh in textures_path, resized to (texture_size, texture_size)
+def load_texture(textures_path, geometry_path, texture_size, device):
+    mesh_name = get_fn(geometry_path)
+    texture = imread(os.path.join(textures_path, f'{mesh_name}.png'))
+    texture = resize(texture, (texture_size, texture_size))
+    return torch.tensor(texture, dtype=torch.float32, device=device)
+
+def set_envmap_rotation(envmap, rangle):
+    env_to_world = torch.tensor(get_rotation_matrix_y(rangle),
+            dtype=torch.float32)
+    envmap.env_to_world = env_to_world
+    envmap.world_to_env = torch.inverse(env_to_world).contiguous()
@@ -15,10 +15,11 @@ class ConfigSampler(object):
             config[key] = sampler()
         return config
 
-def PathSamplerFactory(root_dir, ext=None):
+# Samplers draw from rng, the random module or a private random.Random
+def PathSamplerFactory(root_dir, ext=None, rng=random):
     path_list = get_child_paths(root_dir, ext)
     def sampler():
-        return random.choice(path_list)
+        return rng.choice(path_list)
     return sampler
 
 def ConstantSamplerFactory(value):
@@ -26,37 +27,59 @@ def ConstantSamplerFactory(value):
         return value
     return sampler
 
-def RandIntSamplerFactory(min_val, max_val):
+def RandIntSamplerFactory(min_val, max_val, rng=random):
     def sampler():
-        return random.randint(min_val, max_val)
+        return rng.randint(min_val, max_val)
     return sampler
 
-def UniformSamplerFactory(min_val, max_val):
+def UniformSamplerFactory(min_val, max_val, rng=random):
     def sampler():
-        return random.uniform(min_val, max_val)
+        return rng.uniform(min_val, max_val)
     return sampler
 
-def RGBFileSamplerFactory(fpath):
+def RGBFileSamplerFactory(fpath, rng=random):
     with open(fpath) as f:
         options = [
                 [float(v)/255.0 for v in s.split(' ')]
                 for s in f.read().strip('\n').split('\n')]
     def sampler():
-        return random.choice(options)
+        return rng.choice(options)
     return sampler
 
 # Note: the ranges are normalized to the range (0, 1)
-def HemisphereSamplerFactory(azimuth_range, elevation_range, up_range):
+def HemisphereSamplerFactory(azimuth_range, elevation_range, up_range, rng=random):
     def sampler():
-        azim = random.uniform(*azimuth_range) * math.pi * 2
-        elev = math.acos(1 - random.uniform(*elevation_range))
-        ornt = random.uniform(*up_range)
+        azim = rng.uniform(*azimuth_range) * math.pi * 2
+        elev = math.acos(1 - rng.uniform(*elevation_range))
+        ornt = rng.uniform(*up_range)
         return [azim, elev, ornt]
     return sampler
-def BoxSamplerFactory(x_range, y_range, z_range):
+def BoxSamplerFactory(x_range, y_range, z_range, rng=random):
     def sampler():
-        x, y, z = random.uniform(*x_range),\
-                  random.uniform(*y_range),\
-                  random.uniform(*z_range)
+        x, y, z = rng.uniform(*x_range),\
+                  rng.uniform(*y_range),\
+                  rng.uniform(*z_range)
         return [x, y, z]
     return sampler
+
+# Scene distribution of the rendered training targets
+def SceneSamplerFactory(geometry_path, envmaps_path, diffuse_refl_path, rng=random):
+    return ConfigSampler({
+        'cam_rotation'       : HemisphereSamplerFactory(
+                                 [0.0, 0.5], [0.0, 0.0], [0.0, 0.0], rng),
+        'cam_translation'    : BoxSamplerFactory(
+                                 [-0.1, 0.1], [-0.76, -0.74], [-0.1, 0.1], rng),
+        'cam_distance'       : ConstantSamplerFactory(7.0),
+        'cam_fov'            : ConstantSamplerFactory([45.0]),
+        'cam_resolution'     : ConstantSamplerFactory([256, 256]),
+        'geometry_path'      : PathSamplerFactory(geometry_path, ext='pth', rng=rng),
+        'tex_diffuse_color'  : RGBFileSamplerFactory(diffuse_refl_path, rng),
+        'tex_specular_color' : ConstantSamplerFactory([0.8, 0.8, 0.8]),
+        'envmap_path'        : PathSamplerFactory(envmaps_path, ext='exr', rng=rng),
+        'envmap_signal_mean' : ConstantSamplerFactory(0.5),
+        'envmap_rotation'    : ConstantSamplerFactory(0.0),
+        'opt_num_samples'    : ConstantSamplerFactory((200, 1)),
+        'opt_max_bounces'    : ConstantSamplerFactory(2),
+        'opt_channels_str'   : ConstantSamplerFactory(['radiance', 'alpha']),
+        'opt_render_seed'    : RandIntSamplerFactory(0, 1e6, rng),
+    })
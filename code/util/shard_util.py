@@ -0,0 +1,172 @@
+import json
+import mmap
+import os
+
+import numpy as np
+
+from .image_util import decode_lut
+
+
+# Record blocks start on cache line boundaries
+BLOCK_ALIGN = 64
+# Number of following records the reader asks the kernel to prefetch
+PREFETCH_RECORDS = 8
+
+
+def aligned(size):
+    return (size + BLOCK_ALIGN - 1) // BLOCK_ALIGN * BLOCK_ALIGN
+
+
+class ShardWriter(object):
+    # Packs (image, mask, config) records into shard_<n>.bin files of about
+    # shard_bytes each. Every record is an (H, W, 3) image block, an (H, W, 1)
+    # mask block and a JSON config block, all in the shard dtype:
+    #   uint8   - gamma encoded 8 bit values as stored in the PNGs
+    #   float16 - linear values as returned by imread
+    # index.json maps keys to (shard, offset, config length) and is written on
+    # close, so readers never see a partially written dataset
+    def __init__(self, root, shape, dtype='uint8', shard_bytes=256 << 20):
+        super(ShardWriter, self).__init__()
+        assert dtype in ('uint8', 'float16'), f'Unsupported shard dtype {dtype}'
+        self.root = root
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shard_bytes = shard_bytes
+        self.shards = list()
+        self.records = dict()
+        self.file = None
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def block_bytes(self, channels):
+        return self.shape[0] * self.shape[1] * channels * self.dtype.itemsize
+
+    def write_block(self, data):
+        self.file.write(data)
+        self.file.write(b'\0' * (aligned(len(data)) - len(data)))
+
+    def add(self, key, img, mask, config):
+        assert img.shape == self.shape + (3,) and mask.shape == self.shape + (1,)
+        if self.file is None or self.file.tell() >= self.shard_bytes:
+            self.next_shard()
+        config = json.dumps(config).encode('utf-8')
+        self.records[key] = [len(self.shards) - 1, self.file.tell(), len(config)]
+        self.write_block(np.ascontiguousarray(img, dtype=self.dtype).tobytes())
+        self.write_block(np.ascontiguousarray(mask, dtype=self.dtype).tobytes())
+        self.write_block(config)
+
+    def next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        self.shards.append(f'shard_{len(self.shards):05d}.bin')
+        self.file = open(os.path.join(self.root, self.shards[-1]), 'wb')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        index_path = os.path.join(self.root, 'index.json')
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({
+                'shape': list(self.shape),
+                'dtype': self.dtype.name,
+                'shards': self.shards,
+                'records': self.records,
+            }, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader(object):
+    # Random access to the records of a ShardWriter directory through read
+    # only memory maps. Shards are mapped lazily so readers can be handed to
+    # DataLoader workers, and reading a record asks the kernel to prefetch
+    # the records that follow it in the shard.
+    def __init__(self, root, prefetch=PREFETCH_RECORDS):
+        super(ShardReader, self).__init__()
+        with open(os.path.join(root, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.root = root
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.shards = index['shards']
+        self.records = index['records']
+        self.prefetch = prefetch
+        self.maps = dict()
+
+        self.img_bytes = aligned(self.shape[0] * self.shape[1] * 3 * self.dtype.itemsize)
+        self.mask_bytes = aligned(self.shape[0] * self.shape[1] * self.dtype.itemsize)
+
+        # Record offsets per shard in file order, for prefetching
+        self.shard_keys = [list() for _ in self.shards]
+        for key, (shard, offset, _) in sorted(self.records.items(), key=lambda r: r[1][:2]):
+            self.shard_keys[shard].append(key)
+        self.positions = {
+            key: i for keys in self.shard_keys for i, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['maps'] = dict()
+        return state
+
+    def shard_map(self, shard):
+        if shard not in self.maps:
+            with open(os.path.join(self.root, self.shards[shard]), 'rb') as f:
+                self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def record_bytes(self, key):
+        return self.img_bytes + self.mask_bytes + aligned(self.records[key][2])
+
+    def advise(self, shard, key):
+        # Prefetch the following records of the shard
+        buf = self.shard_map(shard)
+        if self.prefetch <= 0 or not hasattr(buf, 'madvise'):
+            return
+        keys = self.shard_keys[shard]
+        position = self.positions[key]
+        following = keys[position + 1:position + 1 + self.prefetch]
+        if len(following) == 0:
+            return
+        start = self.records[following[0]][1] // mmap.PAGESIZE * mmap.PAGESIZE
+        end = self.records[following[-1]][1] + self.record_bytes(following[-1])
+        buf.madvise(mmap.MADV_WILLNEED, start, min(end, len(buf)) - start)
+
+    def raw(self, key):
+        # Zero-copy (H, W, 3) image and (H, W, 1) mask views and the config
+        shard, offset, config_len = self.records[key]
+        buf = self.shard_map(shard)
+        height, width = self.shape
+        img = np.frombuffer(buf, dtype=self.dtype, count=height * width * 3,
+                            offset=offset).reshape(height, width, 3)
+        offset += self.img_bytes
+        mask = np.frombuffer(buf, dtype=self.dtype, count=height * width,
+                             offset=offset).reshape(height, width, 1)
+        offset += self.mask_bytes
+        config = json.loads(buf[offset:offset + config_len].decode('utf-8'))
+        self.advise(shard, key)
+        return img, mask, config
+
+    def read(self, key, dtype=np.float32):
+        # Linear image and mask decoded the same way imread decodes the PNGs
+        img, mask, config = self.raw(key)
+        if self.dtype == np.uint8:
+            lut = decode_lut(np.uint8, dtype, 2.2)
+            return lut[img], lut[mask], config
+        return img.astype(dtype), mask.astype(dtype), config
+
+    def close(self):
+        for buf in self.maps.values():
+            buf.close()
+        self.maps = dict()
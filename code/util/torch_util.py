@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 
 from .render_util import *
@@ -5,13 +6,28 @@ from .transform_util import *
 
 
 class RenderLayer(nn.Module):
+    # Subclasses swap the renderer by overriding renderer_class
+    renderer_class = Render
+
     def __init__(self, *args, **kwargs):
         super(RenderLayer, self).__init__()
-        self.renderer = Render(*args, **kwargs)
-
-    def forward(self, input):
-        out = self.renderer(input)
-        return out
+        self.renderer = self.renderer_class(*args, **kwargs)
+
+    def forward(self, input, scenes=None):
+        # Single HWC texture rendered with the scene currently set in config
+        if scenes is None:
+            return self.renderer(input)
+        # NCHW batch of textures rendered with one scene config each
+        assert(input.dim() == 4 and input.shape[0] == len(scenes))
+        to_hwc, to_chw = CHW2HWC(), HWC2CHW()
+        out = list()
+        for texture, scene in zip(input, scenes):
+            self.renderer.config.set_scene(scene)
+            out.append(to_chw(self.renderer(to_hwc(texture))))
+        return torch.stack(out)
+
+class DeferredRenderLayer(RenderLayer):
+    renderer_class = DeferredRender
 
 class PostCompositLayer(nn.Module):
     def __init__(self, *args, **kwargs):
@@ -53,6 +69,22 @@ class CHW2HWCLayer(nn.Module):
     def forward(self, input):
         return self.transform(input)
 
+class NCHW2NHWCLayer(nn.Module):
+    def __init__(self, *args, **kwargs):
+        super(NCHW2NHWCLayer, self).__init__()
+        self.transform = NCHW2NHWC(*args, **kwargs)
+
+    def forward(self, input):
+        return self.transform(input)
+
+class NHWC2NCHWLayer(nn.Module):
+    def __init__(self, *args, **kwargs):
+        super(NHWC2NCHWLayer, self).__init__()
+        self.transform = NHWC2NCHW(*args, **kwargs)
+
+    def forward(self, input):
+        return self.transform(input)
+
 class NormalizeLayer(nn.Module):
     def __init__(self, *args, **kwargs):
         super(NormalizeLayer, self).__init__()
@@ -17,7 +17,7 @@ class Debug(object):
         return input
 
 class GaussianNoise(object):
-    # NOTE: Assumes input is HWC Formatted Image
+    # NOTE: Assumes input is HWC (or NHWC) Formatted Image
     #       If input has 4 channels, it will ignore the alpha channel
     def __init__(self, sigma, device):
         super(GaussianNoise, self).__init__()
@@ -29,7 +29,7 @@ class GaussianNoise(object):
             scale = self.sigma * input.detach()
             # no noise in alpha channel
             if input.size()[-1] == 4:
-                scale[:,:,-1] *= 0
+                scale[...,-1] *= 0
             sampled_noise = self.noise.repeat(*input[...,:1].shape).normal_() * scale
             input = input + sampled_noise
         return input
@@ -72,9 +72,9 @@ class Composit(object):
                 device=device)
 
     def __call__(self, input):
-        # input is in format HWC
-        alpha = input[:,:,-1:]
-        return alpha * input[:,:,:-1] + (1 - alpha) * self.background
+        # input is in format HWC or NHWC
+        alpha = input[...,-1:]
+        return alpha * input[...,:-1] + (1 - alpha) * self.background
 
 class Compose(object):
     def __init__(self, transform_list):
@@ -160,6 +160,22 @@ class CHW2HWC(object):
     def __call__(self, input):
         return input.transpose(0, 1).transpose(1, 2).contiguous()
 
+class NCHW2NHWC(object):
+    def __init__(self):
+        super(NCHW2NHWC, self).__init__()
+        pass
+
+    def __call__(self, input):
+        return input.permute(0, 2, 3, 1).contiguous()
+
+class NHWC2NCHW(object):
+    def __init__(self):
+        super(NHWC2NCHW, self).__init__()
+        pass
+
+    def __call__(self, input):
+        return input.permute(0, 3, 1, 2).contiguous()
+
 class Normalize(object):
     def __init__(self, mean, std):
         super(Normalize, self).__init__()